@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+#Benchmarks for the BattleNode game engine, on seeded maps
+#usage: battlenode-bench.py [--only benchmark ...] [--sizes size ...] [--output results.json] [--baseline baseline.json] [--threshold 0.25] [--mindiff 0.01]
+#
+#All results are 'lower is better'. With --baseline, the run fails (exit code 1) if any result is worse than the
+#same result in the baseline by more than the threshold (and, for times, by more than mindiff seconds, so that
+#noise on benchmarks of a few milliseconds does not count). A baseline is simply the --output of an earlier run.
+#Timings are the best of a few runs, on fresh games for the benchmarks that change the game.
+
+import sys
+import os
+import time
+import json
+import random
+import argparse
+import platform
+import tracemalloc
+import importlib.util
+
+def loadserver():
+    #the server is a script (battlenode-server.py), load it as a module
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'battlenode-server.py')
+    spec = importlib.util.spec_from_file_location('battlenode', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+battlenode = loadserver()
+
+defaultsizes = [100, 500, 1000, 2000]
+densities = [0.01, 0.1, 0.5] #fractions of owned nodes for the tick benchmark
+samples = 1000 #number of nodes sampled for the per-node benchmarks
+seed = 1
+
+results = []
+
+
+def report(benchmark, size, value, unit='s', **params):
+    key = " ".join([benchmark, 'size=' + str(size)] + [ k + '=' + str(v) for k, v in sorted(params.items()) ])
+    if unit != 's':
+        key += ' (' + unit + ')'
+    results.append({'key': key, 'benchmark': benchmark, 'size': size, 'params': params, 'value': value, 'unit': unit})
+    print("%-55s %12.4f %s" % (key, value, unit))
+    sys.stdout.flush()
+
+def timeit(f, *args, **kwargs):
+    begin = time.time()
+    result = f(*args, **kwargs)
+    return time.time() - begin, result
+
+def best(f, repeat=3):
+    #best time out of a few runs, for benchmarks without side effects
+    return min( timeit(f)[0] for i in range(repeat) )
+
+def fresh(setup, f, repeat=3):
+    #best time out of a few runs, each on a fresh state from setup() (not timed), for benchmarks that change the game
+    return min( timeit(f, setup())[0] for i in range(repeat) )
+
+
+def populate(game, density, players=2, seed=1):
+    #give a fraction of all nodes to the players (in vertical strips) and link each owned node to an owned neighbour
+    rnd = random.Random(seed)
+    for i in range(players):
+        game.addplayer('player' + str(i+1))
+    for node in list(game):
+        if rnd.random() < density:
+            node.owner = game.players[(node.x - 1) * players // game.width]
+    for node in list(game):
+        if node.owner:
+            for neighbour in node.neighbours():
+                if neighbour.owner:
+                    node.link(neighbour, 1)
+                    break
+    return game
+
+def sample(game, n):
+    #n random (existing) nodes, the same ones on every run
+    rnd = random.Random(seed)
+    nodes = []
+    while len(nodes) < n:
+        node = game.getnode(rnd.randint(1, game.width), rnd.randint(1, game.height))
+        if node is not None:
+            nodes.append(node)
+    return nodes
+
+
+def bench_createnodes(size):
+    repeat = 3 if size <= 500 else 1
+    report('createnodes', size, best(lambda: battlenode.Game('bench', size, size, seed=seed, vectorised=False), repeat), mode='loop')
+    if battlenode.numpy is not None:
+        report('createnodes', size, best(lambda: battlenode.Game('bench', size, size, seed=seed, vectorised=True), repeat), mode='numpy')
+    #lazily generated map, only the chunks around the unowned core get generated
+    report('createnodes', size, best(lambda: battlenode.Game('bench', size, size, seed=seed, lazy=True), repeat), mode='lazy')
+
+def bench_memory(size):
+    tracemalloc.start()
+    game = battlenode.Game('bench', size, size, seed=seed)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    report('memory', size, current / float(size * size), 'B/cell')
+    report('memory', size, peak / float(size * size), 'B/cell', peak=1)
+
+def bench_neighbours(size):
+    nodes = sample(battlenode.Game('bench', size, size, seed=seed), samples)
+    for depth in (1, 3):
+        report('neighbours', size, best(lambda: [ list(node.neighbours(depth)) for node in nodes ]), depth=depth, calls=samples)
+
+def bench_visiblenodes(size):
+    game = battlenode.Game('bench', size, size, seed=seed)
+    nodes = sample(game, samples)
+    for type in ('unspecialised', 'sensor'): #vision 1 and 3
+        for node in nodes:
+            node.type = battlenode.nodetypes[type]
+        report('visiblenodes', size, best(lambda: [ node.visiblenodes() for node in nodes ]), vision=battlenode.nodetypes[type].vision, calls=samples)
+
+def bench_link(size, rounds=10, repeat=5):
+    #heavy link counts: a cluster of nodes linked to all their neighbours, with the links updated over and over
+    def setup():
+        game = battlenode.Game('bench', size, size, seed=seed)
+        game.addplayer('player1')
+        nodes = sample(game, 200)
+        for node in nodes:
+            node.owner = game.players[0]
+        return [ (node, neighbour) for node in nodes for neighbour in node.neighbours() ]
+    def linkall(pairs):
+        for i in range(rounds):
+            for node, neighbour in pairs:
+                node.link(neighbour, 5)
+    report('link', size, fresh(setup, linkall, repeat), calls=len(setup()) * rounds)
+
+def bench_get(size, density=0.2):
+    #full snapshot for a player, in both wire formats
+    game = populate(battlenode.Game('bench', size, size, seed=seed), density, seed=seed)
+    player = game.players[0].name
+    game.get(player=player) #warm up the energy/strength cache, both formats need it
+    for format in ('json', 'binary'):
+        report('get', size, best(lambda: game.get(player=player, format=format)), density=density, format=format)
+        report('get', size, len(game.get(player=player, format=format)) / 1024.0, 'KB', density=density, format=format)
+
+def bench_tick(size, ticks=3):
+    repeat = 3 if size <= 500 else 1
+    def tick(game):
+        for i in range(ticks):
+            try:
+                game.tick()
+            except battlenode.GameOver:
+                pass
+    for density in densities:
+        report('tick', size, fresh(lambda: populate(battlenode.Game('bench', size, size, seed=seed), density, seed=seed), tick, repeat) / ticks, density=density)
+
+
+benchmarks = [
+    ('createnodes', bench_createnodes),
+    ('memory', bench_memory),
+    ('neighbours', bench_neighbours),
+    ('visiblenodes', bench_visiblenodes),
+    ('link', bench_link),
+    ('get', bench_get),
+    ('tick', bench_tick),
+]
+
+
+def compare(baselinefile, threshold, mindiff):
+    #compare the results with a baseline, returns the number of regressions
+    baseline = dict( (result['key'], result['value']) for result in json.load(open(baselinefile))['results'] )
+    regressions = 0
+    print("compared with " + baselinefile + " (threshold " + str(int(threshold * 100)) + "%, at least " + str(mindiff) + " s for times):")
+    for result in results:
+        if result['key'] in baseline and baseline[result['key']] > 0:
+            ratio = result['value'] / baseline[result['key']]
+            if ratio > 1 + threshold and (result['unit'] != 's' or result['value'] - baseline[result['key']] > mindiff):
+                print("REGRESSION %-55s %6.2fx" % (result['key'], ratio))
+                regressions += 1
+            elif ratio < 1 - threshold:
+                print("improved   %-55s %6.2fx" % (result['key'], ratio))
+    if not regressions:
+        print("no regressions")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BattleNode engine benchmarks")
+    parser.add_argument('--only', nargs='+', help="Benchmarks to run: " + ", ".join( name for name, f in benchmarks ), default=None)
+    parser.add_argument('--sizes', nargs='+', type=int, help="Map sizes (width and height)", default=defaultsizes)
+    parser.add_argument('-o', '--output', type=str, help="Write the results to this file (JSON), usable as a baseline later", default=None)
+    parser.add_argument('-b', '--baseline', type=str, help="Compare with the results in this file and fail on regressions", default=None)
+    parser.add_argument('-t', '--threshold', type=float, help="Allowed slowdown against the baseline, as a fraction", default=0.25)
+    parser.add_argument('--mindiff', type=float, help="Slowdowns of up to this many seconds are never regressions (noise)", default=0.01)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        for name, f in benchmarks:
+            if args.only is None or name in args.only:
+                f(size)
+
+    if args.output:
+        f = open(args.output, 'w')
+        json.dump({'python': platform.python_version(), 'numpy': battlenode.numpy is not None, 'results': results}, f, indent=1)
+        f.close()
+    if args.baseline and compare(args.baseline, args.threshold, args.mindiff):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
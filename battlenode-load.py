@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+#Load test of the BattleNode HTTP server: starts a server locally, creates games, and lets simulated players play them over HTTP
+#usage: battlenode-load.py [-g games] [-p players] [-t turns] [-W width] [-H height] [--workers n] [--syncticks] [--output results.json]
+#       battlenode-load.py --url http://host:port [...]  (against a running server, without CPU and memory figures)
+#
+#Every player is a thread with its own (keep-alive) connection, running a client's turn loop: a GET with init=1 once,
+#then per turn a state GET (the full view first, the changes since the last turn after that), a few link POSTs, now
+#and then a spec POST, and done, followed by polls until the other players are done too. Reports the throughput and the
+#p50/p99 latency per endpoint, and the CPU time and memory of the server process (and its workers).
+
+import sys
+import os
+import time
+import json
+import random
+import argparse
+import threading
+import subprocess
+import importlib.util
+from collections import defaultdict
+from http.client import HTTPConnection
+from urllib.parse import urlencode, urlparse, quote
+
+def loadserver():
+    #the server is a script (battlenode-server.py), load it as a module
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'battlenode-server.py')
+    spec = importlib.util.spec_from_file_location('battlenode', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+battlenode = loadserver()
+
+startuptimeout = 15 #seconds to wait for a started server to accept requests
+pollinterval = 0.05 #seconds between polls while waiting for other players
+
+
+class Latencies:
+    #latencies per endpoint, shared by all player threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list) #endpoint => seconds
+        self.errors = defaultdict(int) #endpoint => number of failed requests
+
+    def add(self, endpoint, latency, error=False):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            if error:
+                self.errors[endpoint] += 1
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+class Client:
+    #one HTTP connection, all requests are timed and recorded per endpoint
+
+    def __init__(self, host, port, latencies):
+        self.connection = HTTPConnection(host, port, timeout=battlenode.longpoll_timeout)
+        self.latencies = latencies
+
+    def call(self, method, endpoint, path, args):
+        #returns the status and the body, waiting answers (for other players, or a tick in progress) are recorded apart
+        body = urlencode(args)
+        begin = time.time()
+        if method == 'GET':
+            self.connection.request('GET', path + '?' + body)
+        else:
+            self.connection.request('POST', path, body, {'Content-Type': 'application/x-www-form-urlencoded'})
+        response = self.connection.getresponse()
+        data = response.read()
+        latency = time.time() - begin
+        if waiting(data):
+            endpoint += ' (waiting)'
+        self.latencies.add(method + ' ' + endpoint, latency, response.status != 200)
+        return response.status, data
+
+    def close(self):
+        self.connection.close()
+
+
+def waiting(data):
+    return b"'error': 'waiting'" in data
+
+def gameover(data):
+    return b"'gameover'" in data
+
+
+def play(client, game, name, turns, seed, joined=None, over=None, links=3, fraction=0.3, specprob=0.2):
+    #a player's session: join, then a number of turns, returns the number of turns played (fewer if the game ended)
+    #joined is a threading.Barrier shared by the game's players, so the first turn only starts when all have joined,
+    #over a threading.Event shared by them that is set once somebody won, so the others stop waiting for the winner
+    rnd = random.Random(str(seed) + ':' + game + ':' + name)
+    path = '/' + quote(game)
+    version = str(battlenode.VERSION)
+    while True:
+        status, data = client.call('POST', 'join', path, {'command': 'join', 'player': name, 'version': version})
+        if not waiting(data):
+            break
+        time.sleep(pollinterval)
+    if status != 200:
+        raise IOError("Join of " + name + " in " + game + " failed: " + data.decode('utf-8'))
+    if joined is not None:
+        joined.wait()
+    client.call('GET', 'init', path, {'init': 1})
+
+    view = {} #(x, y) => node, kept up to date with the changes
+    since = None
+    for turn in range(turns):
+        args = {'player': name}
+        if since is not None:
+            args['since'] = since
+        while True:
+            status, data = client.call('GET', 'state', path, args)
+            if not waiting(data):
+                break
+            if over is not None and over.is_set():
+                return turn
+            time.sleep(pollinterval)
+        state = json.loads(data.decode('utf-8'))
+        if state['full']:
+            view = {}
+        for x, y in state.get('removed', []):
+            view.pop((x, y), None)
+        for node in state['nodes']:
+            view[(node['x'], node['y'])] = node
+        since = state['time']
+        if any( p['wins'] for p in state['players'] ):
+            if over is not None:
+                over.set()
+            return turn
+        if any( p['name'] == name and p['lost'] for p in state['players'] ):
+            return turn
+
+        owned = [ view[position] for position in sorted(view) if view[position]['owner'] == name ]
+        for node in rnd.sample(owned, min(links, len(owned))):
+            neighbours = [ view[(node['x'] + dx, node['y'] + dy)] for dx in (-1, 0, 1) for dy in (-1, 0, 1) if (dx or dy) and (node['x'] + dx, node['y'] + dy) in view ]
+            power = int(node['energy'] * fraction)
+            if neighbours and power > 0:
+                target = rnd.choice(neighbours)
+                client.call('POST', 'link', path, {'player': name, 'version': version, 'command': 'link', 'x': node['x'], 'y': node['y'], 'targetx': target['x'], 'targety': target['y'], 'power': power})
+        unspecialised = [ node for node in owned if node['type'] == 'unspecialised' ]
+        if unspecialised and rnd.random() < specprob:
+            node = rnd.choice(unspecialised)
+            client.call('POST', 'spec', path, {'player': name, 'version': version, 'command': 'spec', 'x': node['x'], 'y': node['y'], 'type': rnd.choice(('shield', 'sensor'))})
+        status, data = client.call('POST', 'done', path, {'player': name, 'version': version, 'command': 'done'})
+        if gameover(data):
+            #only the tick this done completed can end the game here, somebody won
+            if over is not None:
+                over.set()
+            return turn + 1
+    return turns
+
+
+class ServerProcess:
+    #a local server in a subprocess, with CPU and memory figures (Linux /proc) of it and its worker processes
+
+    def __init__(self, port, workers=0, syncticks=False):
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'battlenode-server.py'), '-p', str(port)]
+        if workers:
+            command += ['--workers', str(workers)]
+        if syncticks:
+            command.append('--syncticks')
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.port = port
+        self.workers = workers
+
+    def wait(self, host):
+        #until the server accepts requests (with workers: the router, and all workers are up)
+        begin = time.time()
+        while time.time() - begin < startuptimeout:
+            if self.process.poll() is not None:
+                raise IOError("Server exited with code " + str(self.process.returncode))
+            try:
+                connection = HTTPConnection(host, self.port, timeout=1)
+                connection.request('GET', '/shards' if self.workers else '/')
+                response = connection.getresponse()
+                data = response.read()
+                connection.close()
+                if response.status == 200 and (not self.workers or all( worker['alive'] for worker in json.loads(data.decode('utf-8'))['workers'] )):
+                    return
+            except (IOError, OSError):
+                pass
+            time.sleep(0.1)
+        raise IOError("Server did not start within " + str(startuptimeout) + " seconds")
+
+    def pids(self):
+        #the server and its child processes (the workers in sharded mode)
+        pids = [self.process.pid]
+        for pid in os.listdir('/proc'):
+            if pid.isdigit():
+                try:
+                    if int(open('/proc/' + pid + '/stat').read().rsplit(')', 1)[1].split()[1]) == self.process.pid:
+                        pids.append(int(pid))
+                except (IOError, OSError, IndexError):
+                    pass #process is gone
+        return pids
+
+    def stats(self):
+        #CPU seconds (user and system), resident and peak resident memory in MB, summed over the processes, or None if unknown
+        if not os.path.exists('/proc/' + str(self.process.pid) + '/stat'):
+            return None
+        clocktick = float(os.sysconf('SC_CLK_TCK'))
+        cpu = rss = peak = 0
+        for pid in self.pids():
+            try:
+                fields = open('/proc/' + str(pid) + '/stat').read().rsplit(')', 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / clocktick
+                for line in open('/proc/' + str(pid) + '/status'):
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) / 1024.0
+                    elif line.startswith('VmHWM:'):
+                        peak += int(line.split()[1]) / 1024.0
+            except (IOError, OSError, IndexError):
+                pass
+        return {'cpu': cpu, 'rss': rss, 'peak': peak}
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def creategame(host, port, name, width, height, seed, lazy):
+    connection = HTTPConnection(host, port)
+    args = {'name': name, 'width': width, 'height': height, 'seed': seed}
+    if lazy:
+        args['lazy'] = 1
+    connection.request('POST', '/', urlencode(args), {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = connection.getresponse()
+    data = response.read()
+    connection.close()
+    if response.status != 200:
+        raise IOError("Creating game " + name + " failed: " + data.decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BattleNode HTTP load test")
+    parser.add_argument('-g', '--games', type=int, help="Number of games", default=4)
+    parser.add_argument('-p', '--players', type=int, help="Number of players per game", default=4)
+    parser.add_argument('-t', '--turns', type=int, help="Number of turns every player plays", default=20)
+    parser.add_argument('-W', '--width', type=int, default=100)
+    parser.add_argument('-H', '--height', type=int, default=100)
+    parser.add_argument('-s', '--seed', type=int, help="Seed of the first game, the others follow", default=1)
+    parser.add_argument('--lazy', action='store_true', help="Create the games with lazily generated maps")
+    parser.add_argument('--port', type=int, help="Port for the local server", default=7460)
+    parser.add_argument('--workers', type=int, help="Start the local server in sharded mode with this many workers", default=0)
+    parser.add_argument('--syncticks', action='store_true', help="Start the local server with ticks on the reactor thread")
+    parser.add_argument('--url', type=str, help="Test a running server instead of starting one (no CPU and memory figures)", default=None)
+    parser.add_argument('-o', '--output', type=str, help="Write the results to this file (JSON)", default=None)
+    args = parser.parse_args()
+
+    if args.url:
+        url = urlparse(args.url)
+        host, port = url.hostname, url.port or 80
+        serverprocess = None
+    else:
+        host, port = '127.0.0.1', args.port
+        serverprocess = ServerProcess(port, args.workers, args.syncticks)
+    try:
+        if serverprocess:
+            serverprocess.wait(host)
+        prefix = 'load' + str(int(time.time())) + '-' #fresh game names on every run, also against a running server
+        games = [ prefix + str(i+1) for i in range(args.games) ]
+        for i, game in enumerate(games):
+            creategame(host, port, game, args.width, args.height, args.seed + i, args.lazy)
+
+        latencies = Latencies()
+        failures = []
+        joined = dict( (game, threading.Barrier(args.players)) for game in games )
+        over = dict( (game, threading.Event()) for game in games )
+        played = dict( (game, []) for game in games ) #game => turns played by each of its players
+        def run(game, name):
+            client = Client(host, port, latencies)
+            try:
+                played[game].append(play(client, game, name, args.turns, args.seed, joined[game], over[game]))
+            except Exception as e:
+                #the others would wait for this player forever
+                joined[game].abort()
+                over[game].set()
+                failures.append(game + '/' + name + ': ' + repr(e))
+            finally:
+                client.close()
+
+        before = serverprocess.stats() if serverprocess else None
+        begin = time.time()
+        threads = [ threading.Thread(target=run, args=(game, 'player' + str(j+1))) for game in games for j in range(args.players) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.time() - begin
+        after = serverprocess.stats() if serverprocess else None
+    finally:
+        if serverprocess:
+            serverprocess.stop()
+
+    ended = dict( (game, max(turns)) for game, turns in played.items() if turns and max(turns) < args.turns ) #games that ended before the last turn (a player won)
+    results = {'games': args.games, 'players': args.players, 'turns': args.turns, 'width': args.width, 'height': args.height, 'duration': duration, 'endpoints': {}, 'failures': failures, 'ended': ended}
+    total = sum( len(values) for values in latencies.latencies.values() )
+    print("%d games x %d players x %d turns on %dx%d maps in %.2f s, %d requests, %.1f requests/s" % (args.games, args.players, args.turns, args.width, args.height, duration, total, total / duration))
+    print("%-28s %8s %10s %10s %10s %7s" % ('endpoint', 'requests', 'req/s', 'p50 (ms)', 'p99 (ms)', 'errors'))
+    for endpoint, values in sorted(latencies.latencies.items()):
+        results['endpoints'][endpoint] = {'requests': len(values), 'throughput': len(values) / duration, 'p50': percentile(values, 0.5), 'p99': percentile(values, 0.99), 'errors': latencies.errors[endpoint]}
+        print("%-28s %8d %10.1f %10.2f %10.2f %7d" % (endpoint, len(values), len(values) / duration, percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000, latencies.errors[endpoint]))
+    if before and after:
+        results['server'] = {'cpu': after['cpu'] - before['cpu'], 'rss': after['rss'], 'peak': after['peak']}
+        print("server: %.2f s CPU (%.0f%% of the run), %.1f MB resident, %.1f MB peak" % (after['cpu'] - before['cpu'], 100 * (after['cpu'] - before['cpu']) / duration, after['rss'], after['peak']))
+    if ended:
+        print("games that ended early: " + ", ".join( game + " after " + str(turns) + " turns" for game, turns in sorted(ended.items()) ))
+    if failures:
+        print("\n".join(failures))
+
+    if args.output:
+        f = open(args.output, 'w')
+        json.dump(results, f, indent=1)
+        f.close()
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,33 @@
 #!/usr/bin/env python
 
 
+import sys
+import os
+import zlib
+import mmap
+import argparse
+import multiprocessing
 import random
 import json
-from collections import defaultdict
-from twisted.web import server, resource
-from twisted.internet import reactor
+import struct
+import hashlib
+import time
+import tempfile
+import cProfile
+import pstats
+from array import array
+from collections import defaultdict, deque
+from twisted.web import server, resource, http, proxy, pages
+from twisted.internet import reactor, protocol, task, threads
+from twisted.python import log
+try:
+    import numpy
+except ImportError:
+    numpy = None #optional, enables vectorised map generation
+try:
+    from urllib.parse import quote, unquote
+except ImportError:
+    from urllib import quote, unquote
 
 VERSION = 0.1
 
@@ -15,6 +37,7 @@ VERSION = 0.1
 
 class Player:
     def __init__(self, name, beginnode):
+        self.id = None #index in Game.players, set by Game.addplayer
         self.name = name
         self.beginnode = beginnode
         self.time = 0
@@ -29,6 +52,7 @@ class Player:
 
     def dict(self):
         return {
+            'id': self.id,
             'name': self.name,
             'beginx': self.beginnode.x,
             'beginy': self.beginnode.y,
@@ -52,6 +76,7 @@ class NodeType:
     def dict(self):
         return {
             'id': self.id,
+            'index': self.index,
             'label': self.label,
             'description': self.description,
             'resistance': self.resistance,
@@ -69,7 +94,8 @@ class Event:
 
     def dict(self):
         return {
-                'id': self.name,
+                'id': self.id,
+                'index': self.index,
                 'label': self.label,
                 'priority': self.priority
         }
@@ -106,6 +132,11 @@ nodetypes = {
     'collaborator':  NodeType('collaborator',"Collaborator node","Feeds power to other players, outgoing connections from the collaborator are never assimilations but give power away and thus allow the formation of alliances and conspiracies", 1, 200, 1, 1, 1 ),
 }
 
+#fixed numbering of node types, used by the grid store
+nodetypelist = [ nodetypes[t] for t in ('unspecialised','shield','sabotage','attack','corruption','destructor','sensor','core','collaborator') ]
+for i, t in enumerate(nodetypelist):
+    t.index = i
+
 events = {
     'lostnode': Event('lostnode', "Node was lost due to insufficient power!",2),
     'lostcloak': Event('lostcloak', "Node lost its cloak due to insufficient power!",3),
@@ -118,6 +149,11 @@ events = {
     'destruction': Event('destruction', "Your specialisation was destroyed!",1),
 }
 
+#fixed numbering of events, used by the grid store
+eventlist = [ events[e] for e in ('lostnode','lostcloak','lostspec','lostassimilated','assimilatesuccess','powerincrease','powerdecrease','corruption','destruction') ]
+for i, e in enumerate(eventlist):
+    e.index = i
+
 #whether a node will specialise or not is dependent on its power, if it specialises, it does so according to thes probabilities:
 seed_defaultspecprobs = {
     (0.8, nodetypes['shield']),
@@ -132,18 +168,949 @@ seed_defaultnonodeprob = 0.16
 seed_defaultbeginpower = 2000
 seed_defaultnullcores = 1
 
+changelog_defaultmaxturns = 50 #clients that are further behind get a full snapshot
+
+longpoll_timeout = 60 #seconds a waiting GET is held open before it is answered with 'waiting'
+
+shard_restartdelay = 1 #seconds before a worker process that died is restarted
+shard_parentcheckinterval = 5 #seconds, workers quit when the router is gone
+
+persist_snapshotinterval = 10 #turns between snapshots of a persisted game
+persist_keepsnapshots = 2 #older snapshots are removed
+
+simulation_defaultturns = 100
+
+tile_defaultsize = 32 #width and height of the tiles the map is divided in, for tile-wise fetching by clients
+
+chunk_defaultsize = 64 #width and height of the chunks of lazily generated maps
+chunk_starttries = 10 #random chunks searched for a start node on a lazily generated map, before generating all of it
+
+metrics_latencybuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5) #seconds
+metrics_sizebuckets = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216) #bytes
+metrics_lagprobeinterval = 0.1 #seconds between probes of how long the reactor was blocked
+
+profile_summarylines = 25 #functions in the summary of a profile, the most expensive ones (cumulative time)
+
+reservednames = ('metrics', 'profile') #paths that can not be game names
+
+#binary wire format (GET with format=binary), little-endian fixed-width records:
+#header, then the players, nodes, links and removed cells. Types, events and players are referred to by the
+#indices/ids from the lookup tables sent at init (get with init=1). Coordinates must fit in 16 bits.
+binary_magic = b'BN'
+binary_version = 1
+binary_header = struct.Struct('<2sBBIiHIII') #magic, format version, flags (1: full snapshot), time, since (-1 if full), number of players, nodes, links, removed
+binary_player = struct.Struct('<HIB') #id, time, flags (1: wins, 2: lost)
+binary_node = struct.Struct('<HHbhBbIfff') #x, y, type index, owner id (-1: none), hidden, lastevent index (-1: none), buildtime, power, energy, strength
+binary_link = struct.Struct('<HHHHf') #sourcex, sourcey, targetx, targety, power
+binary_removed = struct.Struct('<HH') #x, y
+binary_maxcoordinate = 65535 #coordinates are unsigned 16-bit, larger maps can only be fetched as JSON
+
+class Metrics:
+    #counters and histograms in the Prometheus text format, cheap enough to leave on: a dict update per observation
+    #(per game gauges are not kept here, they are computed from the games when scraped, see MetricsResource)
+
+    descriptions = {
+        'battlenode_requests_total': ('counter', "Requests to games, per verb and command (GET: get, wait or stream)"),
+        'battlenode_request_seconds': ('histogram', "Time spent handling a request in the reactor, per verb and command"),
+        'battlenode_ticks_total': ('counter', "Game ticks (turns)"),
+        'battlenode_tick_seconds': ('histogram', "Duration of Game.tick"),
+        'battlenode_tick_nodes_total': ('counter', "Nodes processed by Game.tick"),
+        'battlenode_response_bytes': ('histogram', "Size of response bodies from Game.get, per format"),
+        'battlenode_reactor_lag_seconds': ('histogram', "How much later than scheduled the reactor ran a timed call"),
+        'battlenode_reactor_blocked_seconds_total': ('counter', "Total time the reactor was blocked, as far as the lag probes noticed"),
+    }
+
+    def __init__(self):
+        self.counters = defaultdict(float) #(name, labels) => value
+        self.histograms = {} #(name, labels) => [counts per bucket, sum, count]
+        self.buckets = {} #name => bucket bounds
+
+    def inc(self, name, labels=(), value=1):
+        self.counters[(name, labels)] += value
+
+    def observe(self, name, value, labels=(), buckets=metrics_latencybuckets):
+        key = (name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = [ [0] * len(buckets), 0, 0 ]
+            self.buckets[name] = buckets
+        histogram = self.histograms[key]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+
+    def request(self, request, duration):
+        if request.method == b'POST':
+            command = request.args.get(b'command', [b''])[0]
+            command = command.decode('utf-8') if command in (b'done', b'link', b'spec', b'batch') else 'other'
+        elif b'stream' in request.args:
+            command = 'stream'
+        elif b'wait' in request.args:
+            command = 'wait'
+        else:
+            command = 'get'
+        labels = (('verb', request.method.decode('utf-8')), ('command', command))
+        self.inc('battlenode_requests_total', labels)
+        self.observe('battlenode_request_seconds', duration, labels)
+
+    def startlagprobe(self, interval=metrics_lagprobeinterval):
+        #a timed call that measures how late it runs, anything blocking the reactor delays it
+        state = {'expected': time.time() + interval}
+        def probe():
+            now = time.time()
+            lag = max(now - state['expected'], 0)
+            self.observe('battlenode_reactor_lag_seconds', lag)
+            self.inc('battlenode_reactor_blocked_seconds_total', value=lag)
+            state['expected'] = now + interval
+        self.lagprobe = task.LoopingCall(probe)
+        self.lagprobe.start(interval, now=False)
+
+    def render(self, gauges=(), counters=()):
+        #gauges and counters kept elsewhere (per game): (name, help, [(labels, value)])
+        lines = []
+        names = sorted(set( name for name, labels in list(self.counters) + list(self.histograms) ))
+        for name in names:
+            type, help = self.descriptions.get(name, ('untyped', ''))
+            lines.append('# HELP ' + name + ' ' + help)
+            lines.append('# TYPE ' + name + ' ' + type)
+            for (n, labels), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append(name + formatlabels(labels) + ' ' + repr(value))
+            for (n, labels), (counts, total, count) in sorted(self.histograms.items()):
+                if n == name:
+                    cumulative = 0
+                    for bound, c in zip(self.buckets[name], counts):
+                        cumulative += c
+                        lines.append(name + '_bucket' + formatlabels(labels + (('le', repr(float(bound))),)) + ' ' + str(cumulative))
+                    lines.append(name + '_bucket' + formatlabels(labels + (('le', '+Inf'),)) + ' ' + str(count))
+                    lines.append(name + '_sum' + formatlabels(labels) + ' ' + repr(total))
+                    lines.append(name + '_count' + formatlabels(labels) + ' ' + str(count))
+        for type, (name, help, values) in [ ('gauge', gauge) for gauge in gauges ] + [ ('counter', counter) for counter in counters ]:
+            lines.append('# HELP ' + name + ' ' + help)
+            lines.append('# TYPE ' + name + ' ' + type)
+            for labels, value in values:
+                lines.append(name + formatlabels(labels) + ' ' + str(value))
+        return "\n".join(lines) + "\n"
+
+def formatlabels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join( key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for key, value in labels ) + '}'
+
+metrics = Metrics()
+
+
+class Grid:
+    #compact storage of all node state in typed arrays, indexed by cell
+    #cell = (x-1) * height + (y-1), so it matches a numpy array of shape (width, height)
+
+    fields = (
+        ('type', 'b', -1),      #index in nodetypelist, -1 if there is no node in this cell
+        ('owner', 'h', -1),     #index in Game.players, -1 if unowned
+        ('power', 'd', 0),
+        ('buildtime', 'i', 0),
+        ('hidden', 'b', 0),
+        ('lastevent', 'b', -1), #index in eventlist, -1 if no event
+    )
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.size = width * height
+        for field, typecode, default in self.fields:
+            setattr(self, field, array(typecode, [default]) * self.size)
+        #links are sparse: (source cell, target cell) => Link, plus per cell indexes, only for cells that have links
+        self.links = {}
+        self.outlinks = {} #cell => target cell => Link
+        self.inlinks = {} #cell => source cell => Link
+        #power sums over the links of each cell, kept up to date on every link change (and ownership change),
+        #sparse like the links: only for cells that have links
+        self.outpower = {} #cell => power of the outgoing links
+        self.inpower = {} #cell => power of the incoming links
+        self.friendlypower = {} #cell => power of the incoming links from nodes of the same owner
+        #cells that need processing on a tick (owned or linked), maintained incrementally
+        self.active = set()
+        self.spatial = SpatialIndex(self)
+        #lazily generated maps are divided in square chunks, generated on first access (see lazy() and materialise())
+        self.chunksize = chunk_defaultsize
+        self.chunkcolumns = (width + self.chunksize - 1) // self.chunksize
+        self.chunkrows = (height + self.chunksize - 1) // self.chunksize
+        self.generated = None #a flag per chunk, None if the whole map was generated up front
+        self.pending = 0 #number of chunks not generated yet
+        self.generator = None #called with the region of a chunk (0-based x1, y1 inclusive, x2, y2 exclusive) to fill it
+
+    def lazy(self, generator, generated=None):
+        self.generator = generator
+        self.generated = generated if generated is not None else bytearray(self.chunkcolumns * self.chunkrows)
+        self.pending = self.generated.count(0)
+
+    def materialise(self, x1, y1, x2, y2):
+        #generate the chunks overlapping a region (0-based, inclusive, clipped to the map)
+        size = self.chunksize
+        for cx in range(max(x1, 0) // size, min(x2, self.width - 1) // size + 1):
+            for cy in range(max(y1, 0) // size, min(y2, self.height - 1) // size + 1):
+                chunk = cx * self.chunkrows + cy
+                if not self.generated[chunk]:
+                    #flagged first, the generator may look up nodes in the chunk itself
+                    self.generated[chunk] = 1
+                    self.pending -= 1
+                    self.generator(cx * size, cy * size, min((cx + 1) * size, self.width), min((cy + 1) * size, self.height))
+
+    def cell(self, x, y):
+        if x < 1 or y < 1 or x > self.width or y > self.height:
+            return None
+        return (x-1) * self.height + (y-1)
+
+    def coordinates(self, cell):
+        return cell // self.height + 1, cell % self.height + 1
+
+    def exists(self, x, y):
+        cell = self.cell(x, y)
+        if cell is not None and self.pending:
+            self.materialise(x - 1, y - 1, x - 1, y - 1)
+        return cell is not None and self.type[cell] >= 0
+
+    def setnode(self, x, y, type, owner, power, buildtime, hidden=False):
+        cell = self.cell(x, y)
+        self.type[cell] = type.index
+        self.owner[cell] = owner.id if owner else -1
+        self.power[cell] = power
+        self.buildtime[cell] = buildtime
+        self.hidden[cell] = int(hidden)
+        self.lastevent[cell] = -1
+
+    def load(self, field, values, x=0, y=0):
+        #bulk load a whole field from a numpy array of shape (width, height), or a region of it from a smaller array at x, y (0-based)
+        typecode = dict((f, t) for f, t, d in self.fields)[field]
+        if values.shape == (self.width, self.height):
+            setattr(self, field, array(typecode, values.astype(typecode).tobytes()))
+        else:
+            self.view(field).reshape(self.width, self.height)[x:x+values.shape[0], y:y+values.shape[1]] = values
+
+    def view(self, field):
+        #numpy view (no copy) on a field, for vectorised operations
+        typecode = dict((f, t) for f, t, d in self.fields)[field]
+        return numpy.frombuffer(getattr(self, field), dtype=typecode)
+
+    def getlink(self, source, target):
+        return self.links.get((source, target))
+
+    def addlink(self, link):
+        link.source.game.touch(link.source)
+        link.source.game.touch(link.target)
+        source, target = link.source.cell, link.target.cell
+        self.links[(source, target)] = link
+        self.outlinks.setdefault(source, {})[target] = link
+        self.inlinks.setdefault(target, {})[source] = link
+        self.addpower(source, target, link.power)
+        self.active.add(source)
+        self.active.add(target)
+
+    def removelink(self, link):
+        link.source.game.touch(link.source)
+        link.source.game.touch(link.target)
+        source, target = link.source.cell, link.target.cell
+        del self.links[(source, target)]
+        self.addpower(source, target, -link.power)
+        for links, cell, other in ((self.outlinks, source, target), (self.inlinks, target, source)):
+            del links[cell][other]
+            if not links[cell]:
+                del links[cell]
+        #cells without links have no sums (and no rounding residue)
+        if source not in self.outlinks:
+            del self.outpower[source]
+        if target not in self.inlinks:
+            del self.inpower[target]
+            self.friendlypower.pop(target, None)
+
+    def addpower(self, source, target, power):
+        #a link's power changed by this amount
+        self.outpower[source] = self.outpower.get(source, 0) + power
+        self.inpower[target] = self.inpower.get(target, 0) + power
+        if self.owner[source] == self.owner[target]:
+            self.friendlypower[target] = self.friendlypower.get(target, 0) + power
+
+    def reowned(self, cell, oldowner):
+        #the owner of a cell changed (from oldowner, an owner id), which changes what counts as friendly for its links
+        owner = self.owner[cell]
+        for target, link in self.outlinks.get(cell, {}).items():
+            if self.owner[target] == oldowner:
+                self.friendlypower[target] = self.friendlypower.get(target, 0) - link.power
+            if self.owner[target] == owner:
+                self.friendlypower[target] = self.friendlypower.get(target, 0) + link.power
+        if cell in self.inlinks:
+            self.friendlypower[cell] = sum( link.power for source, link in self.inlinks[cell].items() if self.owner[source] == owner )
+
+    def isactive(self, cell):
+        return self.owner[cell] >= 0 or cell in self.outlinks or cell in self.inlinks
+
+    def prune(self):
+        #drop cells that became inactive (unowned and unlinked)
+        self.active = set( cell for cell in self.active if self.isactive(cell) )
+
+    def nbytes(self):
+        return sum( getattr(self, field).itemsize * self.size for field, typecode, default in self.fields )
+
+
+class SpatialIndex:
+    #neighbour lookups through precomputed stencils: the cell offsets of all cells within a radius
+    #cells away from the map edge find their neighbours by just adding the offsets, only cells near the edge need bounds checks
+    #(the map itself never changes shape, so the stencils are computed once per radius and map)
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.width = grid.width
+        self.height = grid.height
+        self.stencils = {} #radius => (list of (dx, dy), list of cell offsets)
+        self.arrays = {} #radius => (dx, dy, cell offsets) as numpy arrays, for bulk queries
+
+    def stencil(self, radius):
+        try:
+            return self.stencils[radius]
+        except KeyError:
+            #same order as a scan over x, then y, so results are deterministic and match the old generator
+            offsets = [ (dx, dy) for dx in range(-radius, radius + 1) for dy in range(-radius, radius + 1) if dx or dy ]
+            self.stencils[radius] = (offsets, [ dx * self.height + dy for dx, dy in offsets ])
+            return self.stencils[radius]
+
+    def neighbours(self, cell, radius=1):
+        #cells of existing nodes within the radius of a cell, excluding the cell itself
+        type = self.grid.type
+        offsets, celloffsets = self.stencil(radius)
+        x, y = divmod(cell, self.height)
+        if self.grid.pending:
+            self.grid.materialise(x - radius, y - radius, x + radius, y + radius)
+        if radius <= x < self.width - radius and radius <= y < self.height - radius:
+            return [ c for c in [ cell + o for o in celloffsets ] if type[c] >= 0 ]
+        else:
+            width, height = self.width, self.height
+            return [ cell + o for (dx, dy), o in zip(offsets, celloffsets) if 0 <= x + dx < width and 0 <= y + dy < height and type[cell + o] >= 0 ]
+
+    def within(self, cells, radius=1):
+        #bulk query: neighbours of many cells at once, as an array of shape (len(cells), stencil size),
+        #with -1 where there is no node (off the map or an empty cell)
+        if radius not in self.arrays:
+            offsets, celloffsets = self.stencil(radius)
+            self.arrays[radius] = (numpy.array([ dx for dx, dy in offsets ]), numpy.array([ dy for dx, dy in offsets ]), numpy.array(celloffsets))
+        dx, dy, celloffsets = self.arrays[radius]
+        cells = numpy.asarray(cells, dtype=numpy.int64).reshape(-1, 1)
+        if self.grid.pending:
+            #the chunks of the corners of the cells' neighbourhoods (the radius never exceeds the chunk size)
+            size = self.grid.chunksize
+            x, y = cells // self.height, cells % self.height
+            corners = [ numpy.clip(x + dx, 0, self.width - 1) // size * self.grid.chunkrows + numpy.clip(y + dy, 0, self.height - 1) // size for dx in (-radius, radius) for dy in (-radius, radius) ]
+            for chunk in numpy.unique(numpy.concatenate(corners)).tolist():
+                cx, cy = divmod(chunk, self.grid.chunkrows)
+                self.grid.materialise(cx * size, cy * size, cx * size, cy * size)
+        x = cells // self.height + dx
+        y = cells % self.height + dy
+        result = cells + celloffsets
+        inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        result[~inside] = 0
+        result[~inside | (self.grid.view('type')[result] < 0)] = -1
+        return result
+
+
+class VisibilityIndex:
+    #per player reference counts of how many of the player's nodes observe each cell (a node also observes itself)
+    #only updated when a node's ownership, type or specialisation status changes, not rebuilt every tick
+
+    def __init__(self, game):
+        self.game = game
+        self.observing = {} #cell => (player id, radius) of each owned (observing) node
+        self.counts = defaultdict(dict) #player id => cell => number of observing nodes
+
+    def observation(self, node):
+        owner = self.game.grid.owner[node.cell]
+        if owner < 0:
+            return None
+        elif node.specialising():
+            return (owner, 1)
+        else:
+            return (owner, node.type.vision)
+
+    def update(self, node):
+        new = self.observation(node)
+        old = self.observing.get(node.cell)
+        if new == old:
+            return
+        if old:
+            self.observe(node, old, -1)
+            del self.observing[node.cell]
+        if new:
+            self.observe(node, new, 1)
+            self.observing[node.cell] = new
+
+    def observe(self, node, observation, delta):
+        owner, radius = observation
+        counts = self.counts[owner]
+        for cell in [node.cell] + self.game.grid.spatial.neighbours(node.cell, radius):
+            count = counts.get(cell, 0) + delta
+            if count:
+                if count == 1 and delta > 0:
+                    self.game.changelog.enter(owner, cell)
+                    self.game.responses.evict(owner)
+                counts[cell] = count
+            else:
+                del counts[cell]
+                self.game.changelog.leave(owner, cell)
+                self.game.responses.evict(owner)
+
+    def load(self, cells):
+        #bulk build for many owned nodes at once (a restored game), nothing is logged as entering a view
+        game = self.game
+        spatial = game.grid.spatial
+        groups = defaultdict(list) #observation => cells
+        for cell in cells:
+            observation = self.observation(Node(game, *game.grid.coordinates(cell)))
+            if observation:
+                self.observing[cell] = observation
+                groups[observation].append(cell)
+        for (owner, radius), group in groups.items():
+            counts = self.counts[owner]
+            if numpy is not None:
+                observed = numpy.concatenate([ numpy.asarray(group), spatial.within(group, radius).ravel() ])
+                observed, n = numpy.unique(observed[observed >= 0], return_counts=True)
+                for cell, count in zip(observed.tolist(), n.tolist()):
+                    counts[cell] = counts.get(cell, 0) + count
+            else:
+                for cell in group:
+                    for c in [cell] + spatial.neighbours(cell, radius):
+                        counts[c] = counts.get(c, 0) + 1
+
+    def visiblenodes(self, player):
+        #own nodes are not included
+        owner = self.game.grid.owner
+        return set( Node(self.game, *self.game.grid.coordinates(cell)) for cell in self.counts[player.id] if owner[cell] != player.id )
+
+    def view(self, player):
+        #cells the player sees: own nodes and visible nodes
+        return self.counts[player.id]
+
+
+class OwnershipIndex:
+    #per player: the owned cells, the number of owned cores and the total power of the owned nodes
+    #maintained by the Node setters, so questions about a single player never need a scan over the whole map
+
+    def __init__(self, game):
+        self.game = game
+        self.owned = defaultdict(set) #player id => cells
+        self.cores = defaultdict(int) #player id => number of core nodes
+        self.power = defaultdict(float) #player id => total power
+
+    def add(self, cell, owner, sign=1):
+        grid = self.game.grid
+        if sign > 0:
+            self.owned[owner].add(cell)
+        else:
+            self.owned[owner].discard(cell)
+        if grid.type[cell] == nodetypes['core'].index:
+            self.cores[owner] += sign
+        self.power[owner] += sign * grid.power[cell]
+
+    def reowned(self, cell, oldowner):
+        #owner ids, -1 if unowned
+        owner = self.game.grid.owner[cell]
+        if oldowner != owner:
+            if oldowner >= 0:
+                self.add(cell, oldowner, -1)
+            if owner >= 0:
+                self.add(cell, owner)
+
+    def retyped(self, cell, oldtype):
+        #type indices
+        grid = self.game.grid
+        owner = grid.owner[cell]
+        core = nodetypes['core'].index
+        if owner >= 0 and (oldtype == core) != (grid.type[cell] == core):
+            self.cores[owner] += 1 if grid.type[cell] == core else -1
+
+    def repowered(self, cell, oldpower):
+        owner = self.game.grid.owner[cell]
+        if owner >= 0:
+            self.power[owner] += self.game.grid.power[cell] - oldpower
+
+    def load(self, cells):
+        #build from scratch for the owned cells (a restored game)
+        self.owned.clear()
+        self.cores.clear()
+        self.power.clear()
+        for cell in cells:
+            self.add(cell, self.game.grid.owner[cell])
+
+    def nodes(self, player):
+        return [ Node(self.game, *self.game.grid.coordinates(cell)) for cell in sorted(self.owned[player.id]) ]
+
+
+class TileIndex:
+    #the map in fixed-size square tiles, with per player version stamps that change whenever something the player can see
+    #in the tile changes (node state, or nodes entering or leaving the view), so clients only need to re-fetch changed tiles
+    #a player's stamps are brought up to date from the ChangeLog when they are asked for, not on every change (see update())
+    #stamps start at the wall clock time in milliseconds, so they keep increasing over a server restart
+
+    def __init__(self, game, size=tile_defaultsize):
+        self.game = game
+        self.size = size
+        self.columns = (game.width + size - 1) // size
+        self.rows = (game.height + size - 1) // size
+        self.epoch = self.stamp = int(time.time() * 1000) #first and last stamp handed out
+        self.base = defaultdict(lambda: self.epoch) #player id => stamp of all tiles without a stamp of their own
+        self.versions = defaultdict(dict) #player id => tile => stamp
+        self.synced = {} #player id => (time, sequence number) of the last change applied to the player's stamps
+
+    def tile(self, cell):
+        height = self.game.height
+        return (cell // height) // self.size * self.rows + (cell % height) // self.size
+
+    def bump(self, playerid, cells):
+        if cells:
+            self.stamp += 1
+            versions = self.versions[playerid]
+            for cell in cells:
+                versions[self.tile(cell)] = self.stamp
+
+    def bumpall(self, player):
+        #the player sees everything from now on (won or lost)
+        self.stamp += 1
+        self.base[player.id] = self.stamp
+        self.versions[player.id].clear()
+
+    def update(self, player):
+        #applies the changes logged since the last update: changed cells the player sees now, and cells that entered or
+        #left the player's view (which covers cells that changed out of view and entered it since, or the other way round)
+        changelog = self.game.changelog
+        time, sequence = self.synced.get(player.id, (None, 0))
+        if time is None or not changelog.covers(time):
+            #first update, or too far behind to tell what changed: all tiles get a new stamp
+            self.bumpall(player)
+        else:
+            seeall = player.lost or player.wins
+            view = self.game.visibility.view(player)
+            cells = []
+            for turntime, changed, entered, left in changelog.turns:
+                if turntime >= time:
+                    cells.extend( cell for cell, last in changed.items() if last > sequence and (seeall or cell in view) )
+                    cells.extend( cell for cell, last in entered.get(player.id, {}).items() if last > sequence )
+                    cells.extend( cell for cell, last in left.get(player.id, {}).items() if last > sequence )
+            self.bump(player.id, cells)
+        self.synced[player.id] = (self.game.time, changelog.sequence)
+
+    def list(self, player, box=None):
+        #tiles (overlapping the bounding box, if any) with their bounds and version for the player
+        self.update(player)
+        versions = self.versions[player.id]
+        base = self.base[player.id]
+        if box is None:
+            box = (1, 1, self.game.width, self.game.height)
+        x1, y1, x2, y2 = box
+        tiles = []
+        for column in range((x1 - 1) // self.size, (x2 - 1) // self.size + 1):
+            for row in range((y1 - 1) // self.size, (y2 - 1) // self.size + 1):
+                tile = column * self.rows + row
+                tiles.append({
+                    'column': column,
+                    'row': row,
+                    'x1': column * self.size + 1,
+                    'y1': row * self.size + 1,
+                    'x2': min((column + 1) * self.size, self.game.width),
+                    'y2': min((row + 1) * self.size, self.game.height),
+                    'version': versions.get(tile, base),
+                })
+        return tiles
+
+
+class ChangeLog:
+    #bounded log of what changed at which game time, so clients can fetch only the changes since a given time
+    #changes made between ticks are logged under the current time
+    #every change gets a sequence number, so TileIndex can tell which changes it has not seen yet
+
+    def __init__(self, game, maxturns):
+        self.game = game
+        self.maxturns = maxturns
+        self.turns = deque() #(time, changed cells, player id => entered cells, player id => left cells), oldest first, cells map to the sequence number of their last change
+        self.oldest = 0 #oldest time for which all changes are still known
+        self.sequence = 0 #sequence number of the last change
+
+    def current(self):
+        if not self.turns or self.turns[-1][0] != self.game.time:
+            self.turns.append( (self.game.time, {}, defaultdict(dict), defaultdict(dict)) )
+            while len(self.turns) > self.maxturns:
+                self.oldest = self.turns.popleft()[0] + 1
+        return self.turns[-1]
+
+    def record(self, cells):
+        self.sequence += 1
+        self.current()[1].update(dict.fromkeys(cells, self.sequence))
+
+    def enter(self, player, cell):
+        self.sequence += 1
+        self.current()[2][player][cell] = self.sequence
+
+    def leave(self, player, cell):
+        self.sequence += 1
+        self.current()[3][player][cell] = self.sequence
+
+    def covers(self, since):
+        #can we still tell everything that changed since the given time?
+        return self.oldest <= since <= self.game.time
+
+    def changes(self, player, since):
+        #returns (cells with changed state or entering the player's view, cells leaving the player's view)
+        changed = set()
+        left = set()
+        for time, cells, entered, gone in self.turns:
+            if time >= since:
+                changed.update(cells)
+                changed.update(entered.get(player.id, ()))
+                left.update(gone.get(player.id, ()))
+        return changed, left
+
+
+class NodeCache:
+    #memoises Node.energy() and Node.strength() for the current game time
+    #entries are invalidated when a node, or a node it is linked with, changes
+
+    kinds = ('energy', 'strength')
+
+    def __init__(self, game):
+        self.game = game
+        self.time = game.time
+        self.values = dict( (kind, {}) for kind in self.kinds ) #kind => cell => value
+        self.hits = dict( (kind, 0) for kind in self.kinds )
+        self.misses = dict( (kind, 0) for kind in self.kinds )
+
+    def get(self, kind, node, compute):
+        if self.time != self.game.time:
+            #specialisation status depends on time, start afresh every turn
+            self.clear()
+            self.time = self.game.time
+        values = self.values[kind]
+        try:
+            value = values[node.cell]
+            self.hits[kind] += 1
+        except KeyError:
+            value = values[node.cell] = compute()
+            self.misses[kind] += 1
+        return value
+
+    def clear(self):
+        for values in self.values.values():
+            values.clear()
+
+    def invalidate(self, cells):
+        for values in self.values.values():
+            if values:
+                for cell in cells:
+                    values.pop(cell, None)
+
+    def stats(self):
+        d = {}
+        for kind in self.kinds:
+            total = self.hits[kind] + self.misses[kind]
+            d[kind] = {
+                'hits': self.hits[kind],
+                'misses': self.misses[kind],
+                'hitrate': float(self.hits[kind]) / total if total else 0.0,
+            }
+        return d
+
+
+class ResponseCache:
+    #rendered GET responses per player, filled on the first request after a change
+    #an entry is dropped when the game advances, a player finishes a turn, or something the player sees changes
+
+    def __init__(self, game):
+        self.game = game
+        self.entries = defaultdict(dict) #player id (None for init) => request key => (time, etag, body)
+        self.requested = defaultdict(dict) #player id => request key => render function, of all requests this turn
+        self.requestedtime = None #the turn of the requests in self.requested
+        self.frozen = None #while a tick runs elsewhere: the only entries served meanwhile, see freeze()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, player, key, render):
+        #returns (etag, body) with the body in bytes
+        if self.frozen is not None:
+            entry = self.frozen.get(player.id if player else None, {}).get(key)
+            if entry is None:
+                raise Waiting("Turn in progress")
+            self.hits += 1
+            return entry[1], entry[2]
+        entries = self.entries[player.id if player else None]
+        entry = entries.get(key)
+        if entry is not None and entry[0] == self.game.time:
+            self.hits += 1
+        else:
+            entry = entries[key] = self.render(render)
+            self.misses += 1
+            if self.requestedtime != self.game.time:
+                self.requested.clear()
+                self.requestedtime = self.game.time
+            self.requested[player.id if player else None][key] = render
+        return entry[1], entry[2]
+
+    def render(self, render):
+        body = render()
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        return (self.game.time, '"' + hashlib.sha1(body).hexdigest() + '"', body)
+
+    def evict(self, playerid):
+        if self.entries.get(playerid):
+            self.entries[playerid].clear()
+
+    def changed(self, cells):
+        for playerid, entries in self.entries.items():
+            if entries and playerid is not None:
+                player = self.game.players[playerid]
+                if player.lost or player.wins:
+                    #sees everything
+                    entries.clear()
+                else:
+                    view = self.game.visibility.view(player)
+                    for cell in cells:
+                        if cell in view:
+                            entries.clear()
+                            break
+
+    def clear(self):
+        self.entries.clear()
+
+    def freeze(self):
+        #a tick is about to run elsewhere (see Game.freeze()): what was requested this turn by those who are not waiting
+        #for the tick (players who won or lost) is rendered again, as the players' records changed since, and served
+        #until thaw(), so is init (rendered by Game.freeze() right before). Anything else waits for the tick
+        game = self.game
+        self.frozen = {None: dict(self.entries.get(None, {}))}
+        if self.requestedtime == game.time:
+            for playerid, renders in self.requested.items():
+                if playerid is not None and game.players[playerid].time <= game.time:
+                    self.frozen[playerid] = dict( (key, self.render(render)) for key, render in renders.items() )
+        self.entries.clear()
+        self.requested.clear()
+
+    def thaw(self):
+        self.frozen = None
+
+
+class GameStore:
+    #persistence of games in a directory, per game:
+    # <name>.<time>.snapshot - compact binary snapshots, taken every few turns
+    # <name>.log             - append-only journal of all accepted commands (and joins), one JSON object per line
+    #a game is restored by loading the latest snapshot and replaying the journal from the offset recorded in it
+    #
+    #snapshot layout (little-endian): header, JSON metadata, then each Grid field as a raw array in Grid.fields
+    #order, then the links as records. Every section starts at an 8-byte aligned offset, so the grid fields can be
+    #used straight from a memory-mapped file.
+
+    magic = b'BNSNAP01'
+    header = struct.Struct('<8sIIiIQQ') #magic, width, height, time, metadata length, number of links, journal offset
+    link = struct.Struct('<IId') #source cell, target cell, power
+
+    def __init__(self, directory, snapshotinterval=persist_snapshotinterval):
+        self.directory = directory
+        self.snapshotinterval = snapshotinterval
+        self.journals = {} #game name => open journal file
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, name, extension):
+        return os.path.join(self.directory, quote(name, safe='') + '.' + extension)
+
+    def attach(self, game):
+        #persist this game from now on
+        game.journal = self
+        game.listen(self.ontick)
+        self.snapshot(game)
+
+    def ontick(self, game):
+        if game.time % self.snapshotinterval == 0:
+            self.snapshot(game)
+
+    def log(self, game, entry):
+        if game.name not in self.journals:
+            self.journals[game.name] = open(self.path(game.name, 'log'), 'ab')
+        journal = self.journals[game.name]
+        journal.write(json.dumps(entry).encode('utf-8') + b'\n')
+        journal.flush()
+
+    def journaloffset(self, game):
+        if game.name in self.journals:
+            return self.journals[game.name].tell()
+        elif os.path.exists(self.path(game.name, 'log')):
+            return os.path.getsize(self.path(game.name, 'log'))
+        else:
+            return 0
+
+    def snapshots(self, name):
+        #times of the available snapshots of a game, oldest first
+        prefix = quote(name, safe='') + '.'
+        times = []
+        for filename in os.listdir(self.directory):
+            if filename.startswith(prefix) and filename.endswith('.snapshot'):
+                time = filename[len(prefix):-len('.snapshot')]
+                if time.isdigit():
+                    times.append(int(time))
+        return sorted(times)
+
+    def games(self):
+        #names of all games in the store
+        return sorted(set( unquote(filename.rsplit('.', 2)[0]) for filename in os.listdir(self.directory) if filename.endswith('.snapshot') ))
+
+    def snapshot(self, game):
+        grid = game.grid
+        meta = {
+            'name': game.name,
+            'seed': game.seed,
+            'random': game.random.getstate(),
+            'players': [ {'name': p.name, 'beginx': p.beginnode.x, 'beginy': p.beginnode.y, 'time': p.time, 'wins': p.wins, 'lost': p.lost } for p in game.players ],
+            'chunks': dict(game.chunks, generated=grid.generated.hex()) if game.chunks else None, #lazily generated maps
+        }
+        meta = json.dumps(meta).encode('utf-8')
+        links = list(grid.links.values())
+        path = self.path(game.name, str(game.time) + '.snapshot')
+        f = open(path + '.tmp', 'wb')
+        f.write(self.header.pack(self.magic, grid.width, grid.height, game.time, len(meta), len(links), self.journaloffset(game)))
+        f.write(meta)
+        self.align(f)
+        for field, typecode, default in Grid.fields:
+            f.write(getattr(grid, field).tobytes())
+            self.align(f)
+        for link in links:
+            f.write(self.link.pack(link.source.cell, link.target.cell, link.power))
+        f.close()
+        os.rename(path + '.tmp', path) #never leave a partial snapshot behind
+        for time in self.snapshots(game.name)[:-persist_keepsnapshots]:
+            os.remove(self.path(game.name, str(time) + '.snapshot'))
+
+    def align(self, f):
+        f.write(b'\0' * (-f.tell() % 8))
+
+    def loadsnapshot(self, path, usemmap=True):
+        #returns the game and the journal offset to replay from
+        #with usemmap, the grid fields are private (copy-on-write) memory-mapped views on the file
+        f = open(path, 'rb')
+        if usemmap:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        else:
+            data = f.read()
+        f.close()
+        magic, width, height, time, metalength, linkcount, journaloffset = self.header.unpack_from(data)
+        if magic != self.magic:
+            raise IOError("Not a BattleNode snapshot: " + path)
+        offset = self.header.size
+        meta = json.loads(bytes(data[offset:offset+metalength]).decode('utf-8'))
+        offset += metalength
+        offset += -offset % 8
+
+        game = Game(meta['name'], width, height, seed=meta['seed'], generate=False)
+        game.time = time
+        version, state, gauss = meta['random']
+        game.random.setstate((version, tuple(state), gauss))
+        grid = game.grid
+        if meta.get('chunks'):
+            game.chunks = dict(meta['chunks'])
+            grid.lazy(game.generatechunk, bytearray.fromhex(game.chunks.pop('generated')))
+        for field, typecode, default in Grid.fields:
+            length = grid.size * getattr(grid, field).itemsize
+            if usemmap:
+                setattr(grid, field, memoryview(data)[offset:offset+length].cast(typecode))
+            else:
+                values = array(typecode)
+                values.frombytes(data[offset:offset+length])
+                setattr(grid, field, values)
+            offset += length
+            offset += -offset % 8
+        for p in meta['players']:
+            player = Player(p['name'], Node(game, p['beginx'], p['beginy']))
+            player.id = len(game.players)
+            player.time = p['time']
+            player.wins = p['wins']
+            player.lost = p['lost']
+            game.players.append(player)
+        for i in range(linkcount):
+            source, target, power = self.link.unpack_from(data, offset + i * self.link.size)
+            grid.addlink(Link(Node(game, *grid.coordinates(source)), Node(game, *grid.coordinates(target)), power))
+
+        #derived state
+        if numpy is not None:
+            owned = numpy.nonzero(grid.view('owner') >= 0)[0].tolist()
+        else:
+            owned = [ cell for cell, owner in enumerate(grid.owner) if owner >= 0 ]
+        game.visibility.load(owned)
+        game.ownership.load(owned)
+        for cell in owned:
+            grid.active.add(cell)
+            if grid.buildtime[cell] > game.time:
+                game.builds[grid.buildtime[cell]].add(cell)
+        game.changelog = ChangeLog(game, game.changelog.maxturns)
+        game.changelog.oldest = game.time #clients get a full snapshot first
+        game.responses.clear()
+        return game, journaloffset
+
+    def restore(self, name, usemmap=True):
+        #latest snapshot plus the journal since
+        times = self.snapshots(name)
+        if not times:
+            raise IOError("No snapshot for game " + name)
+        game, journaloffset = self.loadsnapshot(self.path(name, str(times[-1]) + '.snapshot'), usemmap)
+        if os.path.exists(self.path(name, 'log')):
+            journal = open(self.path(name, 'log'), 'rb')
+            journal.seek(journaloffset)
+            for line in journal:
+                if line.endswith(b'\n'): #an incomplete last line was never acknowledged
+                    game.replay(json.loads(line.decode('utf-8')))
+            journal.close()
+        game.journal = self
+        game.listen(self.ontick)
+        return game
+
+
 class Game:
-    def __init__(self, name, width, height, seed_beginpower= seed_defaultbeginpower, seed_nonodeprob=seed_defaultnonodeprob, seed_specprobs=seed_defaultspecprobs, seed_hideprob=seed_defaulthideprob, seed_hideprob_spec = seed_defaulthideprob_spec, seed_highpowerprob = seed_defaulthighpowerprob):
+    def __init__(self, name, width, height, seed_beginpower= seed_defaultbeginpower, seed_nonodeprob=seed_defaultnonodeprob, seed_specprobs=seed_defaultspecprobs, seed_hideprob=seed_defaulthideprob, seed_hideprob_spec = seed_defaulthideprob_spec, seed_highpowerprob = seed_defaulthighpowerprob, seed=None, vectorised=True, changelog_maxturns=changelog_defaultmaxturns, generate=True, lazy=False):
         self.name = name
         self.width = width
         self.height = height
         self.players = []
-        self.nodes =  defaultdict(dict) # x => y => Node
+        self.grid = Grid(width, height) #all node state
         self.time = 0
-        self.createnodes(seed_nonodeprob, seed_specprobs, seed_highpowerprob, seed_hideprob, seed_hideprob_spec)
-
-        #self.changednodes = set() #will hold all changed nodes after a tick, needed to update clients
-        self.visiblenodes = defaultdict(set) #will hold all visible nodes for each player
+        self.seed = seed #same seed, same map
+        self.random = random.Random(seed)
+        self.changednodes = set() #will hold all changed nodes after a tick, needed to update clients
+        self.visibility = VisibilityIndex(self) #visible nodes for each player
+        self.ownership = OwnershipIndex(self) #owned nodes, cores and power of each player
+        self.tiles = TileIndex(self) #per player version stamps of the map's tiles
+        self.startnodes = None #cells with enough neighbours for a start node, see startcandidates()
+        self.cache = NodeCache(self) #energy and strength of nodes
+        self.changelog = ChangeLog(self, changelog_maxturns)
+        self.responses = ResponseCache(self)
+        self.builds = defaultdict(set) #time => cells whose specialisation completes at that time
+        self.listeners = [] #callbacks, called with the game after every tick
+        self.journal = None #GameStore that logs accepted commands, if the game is persisted
+        self.ticker = None #if set, done() hands the tick over to it instead of ticking right away (see tickinthread())
+        self.ticking = None #while a tick runs elsewhere: what GETs and /metrics are answered from meanwhile, see freeze()
+        self.lasttick = None #nodes processed and seconds taken by the last tick, see recordtick()
+        self.profiler = None #while the game's ticks or requests are profiled, see Profiler
+        self.lastprofile = None #summary of the last completed profile
+        self.vectorised = vectorised and numpy is not None #map generation with numpy
+        self.chunks = None #lazily generated maps: seed, generator and parameters of the chunks (JSON, persisted), see generatechunk()
+        if not generate:
+            pass #empty map, to be filled by GameStore.loadsnapshot()
+        elif lazy:
+            #only the chunks that are accessed get generated, each from its own seed derived from the map's
+            self.chunks = {
+                'seed': (seed if seed is not None else self.random.getrandbits(32)) & 0xffffffff,
+                'numpy': self.vectorised,
+                'params': [seed_nonodeprob, [ [prob, t.index] for prob, t in self.specprobs(seed_specprobs) ], seed_highpowerprob, seed_hideprob, seed_hideprob_spec],
+            }
+            self.grid.lazy(self.generatechunk)
+            self.makenullcores(seed_defaultnullcores, seed_defaultbeginpower)
+        elif vectorised and numpy is not None:
+            self.createnodes_vectorised(seed_nonodeprob, seed_specprobs, seed_highpowerprob, seed_hideprob, seed_hideprob_spec)
+        else:
+            self.createnodes(seed_nonodeprob, seed_specprobs, seed_highpowerprob, seed_hideprob, seed_hideprob_spec)
 
     def dict(self):
         return {
@@ -152,89 +1119,248 @@ class Game:
                 'width': self.width,
                 'height': self.height,
                 'time': self.time,
-                'version': self.version
+                'version': VERSION
         }
 
+    def nodetypes(self):
+        return [ t.dict() for t in nodetypelist ]
+
+    def events(self):
+        return [ e.dict() for e in eventlist ]
+
     def __iter__(self):
-        for d in self.nodes.values():
-            for node in d.values():
-                yield node
+        if self.grid.pending:
+            self.grid.materialise(0, 0, self.width - 1, self.height - 1)
+        for cell, type in enumerate(self.grid.type):
+            if type >= 0:
+                yield Node(self, *self.grid.coordinates(cell))
+
+    def getnode(self, x, y):
+        if self.grid.exists(x, y):
+            return Node(self, x, y)
+        else:
+            return None
 
     def makebeginnode(self, seed_beginpower):
-        valid = False
-        while not valid:
-            node = random.choice(iter(self))
-            if node.type == 'unspecialised':
-                neighbours = list(node.neighbours())
-                if len(neighbours) >= 6:
-                    node.type = nodetypes['core']
-                    node.power = seed_beginpower
-                    valid = True
+        #a random start node, from the candidates that currently qualify
+        if self.grid.pending:
+            candidates = self.chunkcandidates()
+        else:
+            candidates = self.startcandidates()
+        if not len(candidates):
+            raise CommunicationError("No start position left on the map")
+        cell = int(candidates[self.random.randrange(len(candidates))])
+        node = Node(self, *self.grid.coordinates(cell))
+        node.type = nodetypes['core']
+        node.power = seed_beginpower
+        return node
+
+    def startcandidates(self):
+        #start nodes need at least 6 neighbours, which never changes (the map keeps its shape) so those are found only once,
+        #of these, the unowned unspecialised nodes qualify (a function of the current state, so restored games draw the same)
+        grid = self.grid
+        unspecialised = nodetypes['unspecialised'].index
+        if self.startnodes is None:
+            if numpy is not None:
+                exists = numpy.pad(grid.view('type').reshape(self.width, self.height) >= 0, 1).astype(numpy.int8)
+                neighbours = sum( exists[1+dx:self.width+1+dx, 1+dy:self.height+1+dy] for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy )
+                self.startnodes = numpy.nonzero((neighbours.ravel() >= 6) & (grid.view('type') >= 0))[0].astype(numpy.int32)
+            else:
+                self.startnodes = array('i', [ cell for cell in range(grid.size) if grid.type[cell] >= 0 and len(grid.spatial.neighbours(cell)) >= 6 ])
+        if numpy is not None:
+            return self.startnodes[(grid.view('type')[self.startnodes] == unspecialised) & (grid.view('owner')[self.startnodes] < 0)]
+        else:
+            return [ cell for cell in self.startnodes if grid.type[cell] == unspecialised and grid.owner[cell] < 0 ]
+
+    def chunkcandidates(self, tries=chunk_starttries):
+        #start candidates on a lazily generated map: those in a random chunk, so only that chunk and its borders get generated
+        #(after a few chunks without any, the whole map is generated and all candidates are considered)
+        grid = self.grid
+        unspecialised = nodetypes['unspecialised'].index
+        for i in range(tries):
+            cx, cy = divmod(self.random.randrange(grid.chunkcolumns * grid.chunkrows), grid.chunkrows)
+            x1, y1 = cx * grid.chunksize, cy * grid.chunksize
+            x2, y2 = min(x1 + grid.chunksize, self.width), min(y1 + grid.chunksize, self.height)
+            grid.materialise(x1 - 1, y1 - 1, x2, y2) #with the borders of the neighbouring chunks, for the neighbour counts
+            candidates = [ cell for x in range(x1, x2) for cell in range(x * self.height + y1, x * self.height + y2) if grid.type[cell] == unspecialised and grid.owner[cell] < 0 and len(grid.spatial.neighbours(cell)) >= 6 ]
+            if candidates:
+                return candidates
+        grid.materialise(0, 0, self.width - 1, self.height - 1)
+        return self.startcandidates()
 
 
     def addplayer(self, name):
         beginnode = self.makebeginnode(seed_defaultbeginpower)
         player = Player(name, beginnode)
+        player.id = len(self.players)
+        player.time = self.time #a player that joins later starts in the current turn
         self.players.append(player)
+        self.responses.clear()
         beginnode.owner = player
+        if self.journal:
+            self.journal.log(self, {'time': self.time, 'player': name, 'join': True})
 
 
     def createnodes(self, seed_nonodeprob, seed_specprobs, seed_highpowerprob, seed_hideprob, seed_hideprob_spec, seed_nullcores = seed_defaultnullcores, seed_beginpower = seed_defaultbeginpower):
-        for x in range(1,self.width+1):
-            for y in range(1,self.height+1):
-                if random.random() <= seed_nonodeprob:
+        self.generatenodes(self.random, 0, 0, self.width, self.height, seed_nonodeprob, seed_specprobs, seed_highpowerprob, seed_hideprob, seed_hideprob_spec)
+        self.makenullcores(seed_nullcores, seed_beginpower)
+
+    def generatenodes(self, rnd, x1, y1, x2, y2, seed_nonodeprob, seed_specprobs, seed_highpowerprob, seed_hideprob, seed_hideprob_spec):
+        #the nodes of a region (0-based, x2 and y2 exclusive), drawn from rnd
+        for x in range(x1+1,x2+1):
+            for y in range(y1+1,y2+1):
+                if rnd.random() <= seed_nonodeprob:
                     continue
 
-                power = random.expovariate(1)*10 #exponential distribution
-                if random.random() <= seed_highpowerprob: #chance for a extra high power node
+                power = rnd.expovariate(1)*10 #exponential distribution
+                if rnd.random() <= seed_highpowerprob: #chance for a extra high power node
                     power = power * power #square
 
 
-                hidden = (random.random() < seed_hideprob)
+                hidden = (rnd.random() < seed_hideprob)
 
                 type = nodetypes['unspecialised']
                 hidden = False
                 if power > 0:
                     specprob = 1/power
-                    if random.random() <= specprob:
-                        hidden = (random.random() < seed_hideprob_spec)
-                        r = random.random()
+                    if rnd.random() <= specprob:
+                        hidden = (rnd.random() < seed_hideprob_spec)
+                        r = rnd.random()
                         summed = 0
-                        for prob, t in seed_specprobs:
-                            if r <= summed + t:
+                        for prob, t in self.specprobs(seed_specprobs):
+                            if r <= summed + prob:
                                 type = t
                                 break
-                            summed += t
+                            summed += prob
+
+
+                self.grid.setnode(x, y, type, None, power, 0, hidden)
+
+    def createnodes_vectorised(self, seed_nonodeprob, seed_specprobs, seed_highpowerprob, seed_hideprob, seed_hideprob_spec, seed_nullcores = seed_defaultnullcores, seed_beginpower = seed_defaultbeginpower):
+        #same distributions as createnodes(), but all random draws are made at once by numpy
+        #RandomState is used because its stream is frozen across numpy versions, so a seed always yields the same map
+        self.generatenodes_vectorised(numpy.random.RandomState(self.seed), 0, 0, self.width, self.height, seed_nonodeprob, seed_specprobs, seed_highpowerprob, seed_hideprob, seed_hideprob_spec)
+        self.makenullcores(seed_nullcores, seed_beginpower)
+
+    def generatenodes_vectorised(self, rng, x1, y1, x2, y2, seed_nonodeprob, seed_specprobs, seed_highpowerprob, seed_hideprob, seed_hideprob_spec):
+        #the nodes of a region (0-based, x2 and y2 exclusive), drawn from rng
+        shape = (x2 - x1, y2 - y1)
+
+        exists = rng.random_sample(shape) > seed_nonodeprob
+        power = rng.exponential(1, shape) * 10 #exponential distribution
+        highpower = rng.random_sample(shape) <= seed_highpowerprob #chance for a extra high power node
+        power = numpy.where(highpower, power * power, power)
+
+        specialise = (power > 0) & (rng.random_sample(shape) * power <= 1) #specprob = 1/power
+        hidden = specialise & (rng.random_sample(shape) < seed_hideprob_spec)
+
+        specprobs = self.specprobs(seed_specprobs)
+        types = [ t for prob, t in specprobs ] + [ nodetypes['unspecialised'] ]
+        cumulative = numpy.cumsum([ prob for prob, t in specprobs ])
+        typeindex = numpy.searchsorted(cumulative, rng.random_sample(shape)) #first type whose cumulative probability covers the draw
+        typeindex[~specialise] = len(types) - 1
+        typeids = numpy.array([ t.index for t in types ])[typeindex]
+
+        self.grid.load('type', numpy.where(exists, typeids, -1), x1, y1)
+        self.grid.load('power', numpy.where(exists, power, 0), x1, y1)
+        self.grid.load('hidden', exists & hidden, x1, y1)
+
+    def generatechunk(self, x1, y1, x2, y2):
+        #generator of a lazily generated map (see Grid.materialise()), chunks are seeded by the map's seed and their position,
+        #so a chunk is the same whenever (and in whichever order) it is generated
+        chunk = (x1 // self.grid.chunksize) * self.grid.chunkrows + y1 // self.grid.chunksize
+        seed_nonodeprob, seed_specprobs, seed_highpowerprob, seed_hideprob, seed_hideprob_spec = self.chunks['params']
+        seed_specprobs = [ (prob, nodetypelist[index]) for prob, index in seed_specprobs ]
+        if self.chunks['numpy']:
+            self.generatenodes_vectorised(numpy.random.RandomState([self.chunks['seed'], chunk]), x1, y1, x2, y2, seed_nonodeprob, seed_specprobs, seed_highpowerprob, seed_hideprob, seed_hideprob_spec)
+        else:
+            self.generatenodes(random.Random(str(self.chunks['seed']) + ':' + str(chunk)), x1, y1, x2, y2, seed_nonodeprob, seed_specprobs, seed_highpowerprob, seed_hideprob, seed_hideprob_spec)
+
+    def specprobs(self, seed_specprobs):
+        #seed_specprobs is a set, fix the order so seeded maps are reproducible
+        return sorted(seed_specprobs, key=lambda x: x[1].id)
 
+    def makenullcores(self, seed_nullcores, seed_beginpower):
+        #unowned cores scattered over the map
+        for i in range(0, seed_nullcores):
+            self.makebeginnode(seed_beginpower)
 
-                self.nodes[x][y] = Node(self, x, y, type, None, power, 0, hidden)
+    def visiblenodes(self, player):
+        return self.visibility.visiblenodes(player)
 
-        if seed_nullcores > 0:
-            for i in range(0, seed_nullcores+1):
-                node = self.beginnode(seed_beginpower)
+    def touch(self, node):
+        #node state changed, this also affects energy and strength of the nodes it is linked with
+        cells = [node.cell]
+        cells.extend(self.grid.outlinks.get(node.cell, ()))
+        cells.extend(self.grid.inlinks.get(node.cell, ()))
+        self.cache.invalidate(cells)
+        self.changed(cells)
+
+    def changed(self, cells):
+        #something a client can see changed in these cells
+        self.changelog.record(cells)
+        self.responses.changed(cells)
 
     def waiting(self):
         for player in self.players:
-            if player.time == self.game.time:
+            if player.time == self.time:
                 yield player
 
 
-    def tick(self):
+    def tick(self, notify=True):
         #one time tick (turn), will be call by post() when last player completes his/her turn
-        self.visiblenodes = defaultdict(set)
-        self.cores = defaultdict(int)
-        for node in self:
+        #only active nodes (owned, linked, or changed during the last turn) are processed, unowned unlinked nodes have nothing to do
+        begin = time.time()
+        self.time += 1
+        self.responses.clear()
+        for cell in self.builds.pop(self.time, ()):
+            #nodes that finished specialising get their full strength and vision
+            node = Node(self, *self.grid.coordinates(cell))
+            self.visibility.update(node)
+            self.touch(node)
+        cells = self.grid.active | set( node.cell for node in self.changednodes )
+        self.changednodes = set()
+        for cell in sorted(cells):
+            node = Node(self, *self.grid.coordinates(cell))
             node.tick()
-            if node.owner:
-                self.visiblenodes[node.owner] |= node.visiblenodes()
-            if node.type == nodetypes['core']:
-                self.cores[node.owner] += 1
+        self.grid.prune()
 
-        if len(self.cores) == 1:
-            winner = self.cores.keys()[0]
+        winner = None
+        remaining = [ player for player in self.players if self.ownership.cores[player.id] > 0 ] #players with a core left
+        if len(remaining) == 1:
+            winner = remaining[0]
             winner.wins = True
+            self.tiles.bumpall(winner)
+
+        self.lasttick = (len(cells), time.time() - begin)
+        if notify:
+            #otherwise the caller does both, on the reactor thread (see tickinthread())
+            self.recordtick()
+            self.notify()
+        if winner:
             raise GameOver(winner.name + " wins!")
 
+    def recordtick(self):
+        nodes, duration = self.lasttick
+        metrics.inc('battlenode_ticks_total')
+        metrics.inc('battlenode_tick_nodes_total', value=nodes)
+        metrics.observe('battlenode_tick_seconds', duration)
+
+    def listen(self, callback):
+        self.listeners.append(callback)
+
+    def unlisten(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def notify(self):
+        for callback in list(self.listeners):
+            try:
+                callback(self)
+            except Exception:
+                #a broken listener should not break the game
+                log.err()
+
     def getplayer(self, **kwargs):
         player = None
         if 'player' in kwargs:
@@ -244,17 +1370,31 @@ class Game:
         if not player:
             raise CommunicationError("No valid player specified")
 
-        if player.time > self.game.time:
-            raise Waiting(",".join(self.waiting))
+        if self.ticking is not None:
+            if player.time > self.ticking['time']:
+                raise Waiting("Turn in progress")
+        elif player.time > self.time:
+            raise Waiting(",".join( p.name for p in self.waiting() ))
+        return player
 
 
     def post(self, **kwargs):
+        if self.ticking is not None:
+            raise Waiting("Turn in progress")
 
         if not 'version' in kwargs:
             raise CommunicationError("No version specified")
-        if kwargs.version != VERSION:
+        if kwargs['version'] != str(VERSION):
             raise VersionError("Client and server versions do not match")
 
+        if kwargs.get('command') == 'join':
+            #a new player, with a random start node
+            if not kwargs.get('player'):
+                raise CommunicationError("No player specified")
+            if any( p.name == kwargs['player'] for p in self.players ):
+                raise CommunicationError("Player already exists")
+            self.addplayer(kwargs['player'])
+            return json.dumps({'time': self.time, 'player': self.players[-1].dict()})
 
         player = self.getplayer(**kwargs) #may raise Waiting exception
         if player.lost:
@@ -263,10 +1403,33 @@ class Game:
         if not 'command' in kwargs:
             raise CommunicationError("No command specified")
 
+        if kwargs['command'] == 'batch':
+            #a list of commands (as JSON), validated in one pass and applied all or nothing, only the last may be 'done'
+            try:
+                commands = json.loads(kwargs['commands'])
+                assert isinstance(commands, list) and all( isinstance(command, dict) for command in commands )
+            except:
+                raise CommunicationError("Invalid arguments for batch, expected a JSON list of commands")
+            orders = []
+            for i, command in enumerate(commands):
+                try:
+                    orders.append(self.parsecommand(player, command))
+                except CommunicationError as e:
+                    raise CommunicationError("Command " + str(i) + ": " + str(e))
+                if orders[-1][0] == 'done' and i != len(commands) - 1:
+                    raise CommunicationError("Command " + str(i) + ": done must be the last command")
+            results = self.applycommands(orders, commands)
+            return json.dumps({'time': self.time, 'results': results})
+        else:
+            command = dict( (key, value) for key, value in kwargs.items() if key not in ('version', 'player') )
+            self.applycommands([ self.parsecommand(player, command) ], [command])
+            return json.dumps({'time': self.time})
 
-
-        command = kwargs['command']
-
+    def parsecommand(self, player, kwargs):
+        #validates a command, returns (command, player, sourcenode, targetnode, power, type)
+        command = kwargs['command'] if 'command' in kwargs else None
+        if command not in ('done', 'link', 'spec'):
+            raise CommunicationError("Unknown command: " + str(command))
 
         if 'x' in kwargs and 'y' in kwargs:
             try:
@@ -274,36 +1437,30 @@ class Game:
                 y = int(kwargs['y'])
             except:
                 raise CommunicationError("Invalid (x,y), not numeric")
-            if x in self.nodes and y in self.nodes[x]:
-                sourcenode = self.nodes[x][y]
-            else:
+            sourcenode = self.getnode(x, y)
+            if sourcenode is None:
                 raise CommunicationError("Invalid (x,y), no node there")
             if sourcenode.owner != player:
                 raise CommunicationError("Sourcenode not owned by player!")
         else:
             sourcenode = None
 
-        if command == 'done':
-            player.tick()
-            alldone = True
-            for p in self.players:
-                if p < player.time:
-                    alldone = False
-            if alldone:
-                self.game.tick()
-        elif command == 'link':
+        targetnode = power = type = None
+        if command == 'link':
             if sourcenode is None:
                 raise CommunicationError("No sourcenode specified, required for " +command)
             try:
                 x = int(kwargs['targetx'])
                 y = int(kwargs['targety'])
+                power = int(kwargs['power'])
+                assert power > 0
             except:
-                raise CommunicationError("Invalid arguments for " + command )
-            if x in self.nodes and y in self.nodes[x]:
-                targetnode = self.nodes[x][y]
-                sourcenode.link(targetnode)
-            else:
+                raise CommunicationError("Invalid arguments for " + command + ", expected targetx, targety and power" )
+            targetnode = self.getnode(x, y)
+            if targetnode is None:
                 raise CommunicationError("Target node does not exist!")
+            if targetnode == sourcenode or abs(targetnode.x - sourcenode.x) > 1 or abs(targetnode.y - sourcenode.y) > 1:
+                raise CommunicationError("Target node is not a neighbour!")
         elif command == 'spec':
             if sourcenode is None:
                 raise CommunicationError("No sourcenode specified, required for " +command)
@@ -312,34 +1469,239 @@ class Game:
                 assert newtype in nodetypes
             except:
                 raise CommunicationError("Invalid arguments for " + command + ", expected type")
-            sourcenode.specialise(nodetypes[newtype])
-
-
+            type = nodetypes[newtype]
+        return (command, player, sourcenode, targetnode, power, type)
+
+    def applycommands(self, orders, commands=None):
+        #applies validated commands, if one fails the earlier ones are undone and the exception is passed on
+        #validated commands are logged to the journal (if any) before they are applied, in the form they were received
+        #(commands that get undone here will be undone again when the journal is replayed)
+        undo = []
+        results = []
+        if self.journal and commands is not None and orders:
+            self.journal.log(self, {'time': self.time, 'player': orders[0][1].name, 'commands': commands})
+        try:
+            for command, player, sourcenode, targetnode, power, type in orders:
+                if command == 'done':
+                    results.append({'command': command})
+                    self.done(player)
+                elif command == 'link':
+                    undo.append(sourcenode.savelinks(targetnode))
+                    sourcenode.link(targetnode, power)
+                    link = self.grid.getlink(sourcenode.cell, targetnode.cell)
+                    results.append({'command': command, 'power': link.power if link else 0})
+                elif command == 'spec':
+                    undo.append(sourcenode.savespec())
+                    sourcenode.specialise(type)
+                    results.append({'command': command, 'buildtime': sourcenode.buildtime})
+        except (NotEnoughPower, NonNeighbourLink):
+            for restore in reversed(undo):
+                restore()
+            raise
+        return results
+
+    def replay(self, entry):
+        #re-applies an entry from the journal
+        if entry.get('join'):
+            self.addplayer(entry['player'])
+        else:
+            player = self.getplayer(player=entry['player'])
+            try:
+                self.applycommands([ self.parsecommand(player, command) for command in entry['commands'] ])
+            except (NotEnoughPower, NonNeighbourLink, GameOver):
+                pass #same outcome as when the commands were first received
+
+    def done(self, player):
+        #the player completed his/her turn
+        player.tick()
+        alldone = True
+        for p in self.players:
+            if p.time < player.time and not p.lost:
+                alldone = False
+        if alldone and self.ticker:
+            self.ticker(self) #freezes the game, which renders again what is still served during the tick
+        else:
+            self.responses.clear() #player records are part of every response
+            if alldone:
+                self.tick()
+
+    def freeze(self):
+        #a tick is about to run elsewhere (see tickinthread()): until thaw(), commands are refused and GETs are answered
+        #from responses rendered for the last completed turn, the game itself is not read meanwhile. Those are init and
+        #what players who won or lost asked for this turn, everybody else is waiting for the tick anyway (see ResponseCache.freeze())
+        self.responses.evict(None) #the players' records changed
+        self.getresponse(init='1') #cheap, and wanted by every client that (re)connects
+        self.ticking = {'time': self.time, 'gauges': self.gauges()}
+        self.responses.freeze()
+
+    def thaw(self):
+        self.ticking = None
+        self.responses.thaw()
+
+    def gauges(self):
+        #figures for /metrics, see MetricsResource
+        return {
+            'players': sum( 1 for p in self.players if not p.lost ),
+            'owned': sum( len(cells) for cells in self.ownership.owned.values() ),
+            'links': len(self.grid.links),
+            'time': self.time,
+        }
 
     def get(self, **kwargs):
-        if 'init' in kwargs and kwargs['init'] == 1:
-            #get general status to initialise a client (regardless of player)
+        if 'init' in kwargs and str(kwargs['init']) == '1':
+            #get general status to initialise a client (regardless of player), also the lookup tables for the binary format
             d = {'game': self.dict(), 'nodetypes': self.nodetypes(), 'events': self.events()}
-        else:
-            player = self.getplayer(**kwargs) #may raise Waiting exception
+            body = json.dumps(d)
+            metrics.observe('battlenode_response_bytes', len(body), (('format', 'init'),), metrics_sizebuckets)
+            return body
 
-            #get the state of the game
-            if player.lost or player.wins:
-                #If you win or lose you get to see all nodes
-                d = {'players': [ p.dict() for p in self.players], 'nodes':  [ n.dict() for n in self ]}
+        player = self.getplayer(**kwargs) #may raise Waiting exception
+        box = self.parsebox(kwargs)
+        if 'tiles' in kwargs and str(kwargs['tiles']) == '1':
+            #the tile versions only, clients fetch the tiles that changed with a bounding box
+            body = json.dumps({'time': self.time, 'tilesize': self.tiles.size, 'tiles': self.tiles.list(player, box)})
+            metrics.observe('battlenode_response_bytes', len(body), (('format', 'tiles'),), metrics_sizebuckets)
+            return body
+        format = kwargs.get('format', 'json')
+        if format == 'binary' and max(self.width, self.height) > binary_maxcoordinate:
+            raise CommunicationError("Map too large for the binary format, use format=json")
+        if 'since' in kwargs:
+            state = self.getstate(player, self.parsetime(kwargs['since']), box)
+        else:
+            state = self.getstate(player, box=box)
+        if format == 'json':
+            body = self.encodejson(state)
+        elif format == 'binary':
+            body = self.encodebinary(state)
+        else:
+            raise CommunicationError("Unknown format: " + format)
+        metrics.observe('battlenode_response_bytes', len(body), (('format', format),), metrics_sizebuckets)
+        return body
+
+    def getresponse(self, **kwargs):
+        #like get(), but served from the response cache; returns (etag, body in bytes)
+        if 'init' in kwargs and str(kwargs['init']) == '1':
+            return self.responses.get(None, 'init', lambda: self.get(**kwargs))
+        player = self.getplayer(**kwargs) #may raise Waiting exception
+        key = (kwargs.get('format', 'json'), kwargs.get('since'), kwargs.get('tiles'), self.parsebox(kwargs))
+        return self.responses.get(player, key, lambda: self.get(**kwargs))
+
+    def getstate(self, player, since=None, box=None):
+        #the state of the game as seen by the player: a full snapshot, or the changes since a given time
+        #optionally limited to a bounding box (x1, y1, x2, y2)
+        if player.lost or player.wins:
+            #If you win or lose you get to see all nodes
+            if box is None:
+                nodes = list(self)
             else:
-                d = {'players': [ p.dict() for p in self.players], 'nodes':  [ n.dict() for n in self.visiblenodes ]}
+                if self.grid.pending:
+                    self.grid.materialise(box[0] - 1, box[1] - 1, box[2] - 1, box[3] - 1)
+                nodes = [ Node(self, *self.grid.coordinates(cell)) for cell in self.inbox(None, box) if self.grid.type[cell] >= 0 ]
+            return {'nodes': nodes, 'removed': [], 'time': self.time, 'since': None, 'full': True}
+        elif since is not None and self.changelog.covers(since):
+            return self.getchanges(player, since, box)
+        else:
+            return {'nodes': self.viewnodes(player, box), 'removed': [], 'time': self.time, 'since': None, 'full': True}
+
+    def parsebox(self, kwargs):
+        #bounding box from the x1, y1, x2, y2 arguments (inclusive, clipped to the map), or None
+        if not any( key in kwargs for key in ('x1', 'y1', 'x2', 'y2') ):
+            return None
+        try:
+            x1, y1, x2, y2 = [ int(kwargs[key]) for key in ('x1', 'y1', 'x2', 'y2') ]
+        except (KeyError, ValueError):
+            raise CommunicationError("Invalid bounding box, expected numeric x1, y1, x2 and y2")
+        x1, y1, x2, y2 = max(x1, 1), max(y1, 1), min(x2, self.width), min(y2, self.height)
+        if x1 > x2 or y1 > y2:
+            raise CommunicationError("Invalid bounding box, empty or outside the map")
+        return (x1, y1, x2, y2)
+
+    def inbox(self, cells, box):
+        #the cells (a set or dict, None for all cells) within the bounding box, walks the box or the cells, whichever is smaller
+        if box is None:
+            return cells
+        x1, y1, x2, y2 = box
+        height = self.height
+        if cells is None or (x2 - x1 + 1) * (y2 - y1 + 1) < len(cells):
+            return [ cell for x in range(x1, x2 + 1) for cell in range((x-1) * height + y1 - 1, (x-1) * height + y2) if cells is None or cell in cells ]
+        else:
+            return [ cell for cell in cells if x1 <= cell // height + 1 <= x2 and y1 <= cell % height + 1 <= y2 ]
+
+    def encodejson(self, state):
+        d = {'players': [ p.dict() for p in self.players], 'nodes':  [ n.dict() for n in state['nodes'] ], 'time': state['time'], 'full': state['full']}
+        if not state['full']:
+            d['since'] = state['since']
+            d['removed'] = [ self.grid.coordinates(cell) for cell in state['removed'] ]
         return json.dumps(d)
 
-class Link:
+    def encodebinary(self, state):
+        grid = self.grid
+        players = [ binary_player.pack(p.id, p.time, int(p.wins) | int(p.lost) << 1) for p in self.players ]
+        nodes = []
+        links = {} #links are shared by both their nodes, send them once
+        for n in state['nodes']:
+            cell = n.cell
+            nodes.append(binary_node.pack(n.x, n.y, grid.type[cell], grid.owner[cell], grid.hidden[cell], grid.lastevent[cell], grid.buildtime[cell], grid.power[cell], n.energy(), n.strength()))
+            for link in n.outlinks:
+                links[(cell, link.target.cell)] = link
+            for link in n.inlinks:
+                links[(link.source.cell, cell)] = link
+        links = [ binary_link.pack(link.source.x, link.source.y, link.target.x, link.target.y, link.power) for link in links.values() ]
+        removed = [ binary_removed.pack(*grid.coordinates(cell)) for cell in state['removed'] ]
+        since = -1 if state['since'] is None else state['since']
+        header = binary_header.pack(binary_magic, binary_version, int(state['full']), state['time'], since, len(players), len(nodes), len(links), len(removed))
+        return b''.join([header] + players + nodes + links + removed)
+
+    def parsetime(self, time):
+        try:
+            return int(time)
+        except ValueError:
+            raise CommunicationError("Invalid time, not numeric")
+
+    def viewnodes(self, player, box=None):
+        #own nodes and the nodes visible to the player
+        return [ Node(self, *self.grid.coordinates(cell)) for cell in self.inbox(self.visibility.view(player), box) ]
+
+    def getchanges(self, player, since, box=None):
+        #only the nodes that changed, entered or left the player's view since the given time
+        view = self.visibility.view(player)
+        changed, left = self.changelog.changes(player, since)
+        if box is not None:
+            changed, left = self.inbox(changed, box), self.inbox(left, box)
+        return {
+            'nodes': [ Node(self, *self.grid.coordinates(cell)) for cell in changed if cell in view ],
+            'removed': [ cell for cell in left if cell not in view ],
+            'time': self.time,
+            'since': since,
+            'full': False,
+        }
+
+class Link(object):
     def __init__(self, source, target, power):
         self.source = source
         self.target = target
-        self.power = power
+        self._power = power #Grid.addlink() takes care of the rest
+
+    @property
+    def power(self):
+        return self._power
+
+    @power.setter
+    def power(self, power):
+        grid = self.source.grid
+        if grid.getlink(self.source.cell, self.target.cell) is self:
+            grid.addpower(self.source.cell, self.target.cell, power - self._power)
+        self._power = power
+        self.source.game.touch(self.source)
+        self.source.game.touch(self.target)
 
     def __eq__(self, other):
         return (self.source == other.source and self.target == other.target and self.power == other.power)
 
+    @property
+    def owner(self):
+        return self.source.owner
+
     def dict(self):
         return {
                 'sourcex': self.source.x,
@@ -350,19 +1712,112 @@ class Link:
         }
 
 
-class Node:
-    def __init__(self, game, x, y, type, owner, power, buildtime, hidden=False):
+class Node(object):
+    #lightweight view on a cell of the game's Grid, all state lives in the grid
+    __slots__ = ('game', 'grid', 'x', 'y', 'cell')
+
+    def __init__(self, game, x, y):
         self.game = game
+        self.grid = game.grid
         self.x = x
         self.y = y
-        self.type = type
-        self.power = power #subgrid power
-        self.outlinks = []
-        self.inlinks = []
-        self.owner = owner
-        self.buildtime = buildtime #from what time on is this node built? (may be in future, node will then be in a reconfigure mode and acts as a normal node until done)
-        self.hidden = hidden
-        self.lastevent = None
+        self.cell = (x-1) * self.grid.height + (y-1)
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and self.cell == other.cell and self.game is other.game
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self.cell
+
+    def __repr__(self):
+        return "<Node " + str(self.x) + "," + str(self.y) + ">"
+
+    @property
+    def type(self):
+        type = self.grid.type[self.cell]
+        return nodetypelist[type] if type >= 0 else None #None if there is no node in this cell
+
+    @type.setter
+    def type(self, type):
+        oldtype = self.grid.type[self.cell]
+        self.grid.type[self.cell] = type.index
+        self.game.ownership.retyped(self.cell, oldtype)
+        self.game.visibility.update(self)
+        self.game.touch(self)
+
+    @property
+    def owner(self):
+        owner = self.grid.owner[self.cell]
+        return self.game.players[owner] if owner >= 0 else None
+
+    @owner.setter
+    def owner(self, owner):
+        oldowner = self.grid.owner[self.cell]
+        self.grid.owner[self.cell] = owner.id if owner else -1
+        if self.cell in self.grid.outlinks or self.cell in self.grid.inlinks:
+            self.grid.reowned(self.cell, oldowner)
+        self.game.ownership.reowned(self.cell, oldowner)
+        if owner:
+            self.grid.active.add(self.cell)
+        self.game.visibility.update(self)
+        self.game.touch(self)
+
+    @property
+    def power(self):
+        #subgrid power
+        return self.grid.power[self.cell]
+
+    @power.setter
+    def power(self, power):
+        oldpower = self.grid.power[self.cell]
+        self.grid.power[self.cell] = power
+        self.game.ownership.repowered(self.cell, oldpower)
+        self.game.touch(self)
+
+    @property
+    def buildtime(self):
+        #from what time on is this node built? (may be in future, node will then be in a reconfigure mode and acts as a normal node until done)
+        return self.grid.buildtime[self.cell]
+
+    @buildtime.setter
+    def buildtime(self, buildtime):
+        self.grid.buildtime[self.cell] = buildtime
+        if buildtime > self.game.time:
+            self.game.builds[buildtime].add(self.cell)
+        self.game.visibility.update(self)
+        self.game.touch(self)
+
+    @property
+    def hidden(self):
+        return bool(self.grid.hidden[self.cell])
+
+    @hidden.setter
+    def hidden(self, hidden):
+        self.grid.hidden[self.cell] = int(hidden)
+        self.game.touch(self)
+
+    @property
+    def lastevent(self):
+        event = self.grid.lastevent[self.cell]
+        return eventlist[event] if event >= 0 else None
+
+    @lastevent.setter
+    def lastevent(self, event):
+        self.grid.lastevent[self.cell] = event.index if event else -1
+        self.game.changed([self.cell])
+
+    @property
+    def outlinks(self):
+        links = self.grid.outlinks.get(self.cell)
+        return links.values() if links else ()
+
+    @property
+    def inlinks(self):
+        links = self.grid.inlinks.get(self.cell)
+        return links.values() if links else ()
 
     def link(self, targetnode, power):
         if targetnode.x == self.x and targetnode.y == self.y:
@@ -370,75 +1825,106 @@ class Node:
         if abs(targetnode.x - self.x) > 1 or abs(targetnode.y - self.y) > 1:
             raise NonNeighbourLink()
 
-        for link in self.outlinks:
-            if link.target == targetnode: #update existing link
-                link.power += power
-                link.target.setevent(events['powerincrease'])
-                return True
+        self.game.changednodes.add(self)
+        self.game.changednodes.add(targetnode)
 
+        link = self.grid.getlink(self.cell, targetnode.cell)
+        if link: #update existing link
+            link.power += power
+            link.target.setevent(events['powerincrease'])
+            return True
 
-        for i, link in enumerate(self.inlinks):
-            if link.source == targetnode and link.source.owner == self.owner: #conflicting reverse link
-                if power < link.power:
-                     link.power -= power
-                     return True
-                else:
-                    power -= link.power
-                    #deletion
-                    link.source.inlinks.remove(link)
-                    del self.inlinks[i]
-                    return True
+        link = self.grid.getlink(targetnode.cell, self.cell)
+        if link and link.source.owner == self.owner: #conflicting reverse link
+            if power < link.power:
+                 link.power -= power
+                 return True
+            else:
+                power -= link.power
+                #deletion
+                self.grid.removelink(link)
+                return True
 
         link = Link(self, targetnode, power )
-        self.outlinks.append(link)
-        self.targetnode.inlinks.append(link)
+        self.grid.addlink(link)
+
+    def savelinks(self, targetnode):
+        #returns a function that restores the links between this node and the target node to their current state
+        pairs = ((self.cell, targetnode.cell), (targetnode.cell, self.cell))
+        links = [ (link.source, link.target, link.power) for link in [ self.grid.getlink(*pair) for pair in pairs ] if link ]
+        lastevent = targetnode.lastevent
+        def restore():
+            for link in [ self.grid.getlink(*pair) for pair in pairs ]:
+                if link:
+                    self.grid.removelink(link)
+            for source, target, power in links:
+                self.grid.addlink(Link(source, target, power))
+            targetnode.lastevent = lastevent
+        return restore
+
+    def savespec(self):
+        #returns a function that restores the current specialisation
+        type = self.type
+        buildtime = self.buildtime
+        def restore():
+            self.type = type
+            self.buildtime = buildtime
+        return restore
 
     def hide(self):
-        if self.energy - self.type.consumption <= 0:
+        if self.energy() - self.type.consumption <= 0:
             raise NotEnoughPower()
         else:
             self.hidden = True
+            self.game.changednodes.add(self)
 
 
     def energy(self):
+        return self.game.cache.get('energy', self, self.computeenergy)
+
+    def computeenergy(self):
         if self.hidden:
             energy = self.power - (self.type.consumption * 2)
         else:
             energy = self.power - self.type.consumption
-        for link in self.outlinks:
-            if link.owner == self.owner or self.type == nodetypes['collaborator']:
-                energy = energy - self.link.power
-        for link in self.inlinks:
-            if link.owner == self.owner or self.type == nodetypes['collaborator']:
-                energy = energy + self.link.power
+        #outgoing links are always the node's own, incoming links only count when friendly (or for collaborators)
+        energy = energy - self.grid.outpower.get(self.cell, 0)
+        if self.type == nodetypes['collaborator']:
+            energy = energy + self.grid.inpower.get(self.cell, 0)
+        else:
+            energy = energy + self.grid.friendlypower.get(self.cell, 0)
         return energy
 
     def strength(self):
+        return self.game.cache.get('strength', self, self.computestrength)
+
+    def computestrength(self):
         if self.specialising():
             return self.energy()
 
         if self.specialising():
             resistance = 1
         else:
-            resistance = self.resistance
+            resistance = self.type.resistance
         #check for sabotaging neighbours
         for link in self.outlinks:
             if link.target.type == nodetypes['sabotage'] and link.target.owner != self.owner and not link.target.specialising():
-                resistance = resistance * link.target.resistancemodifier
+                resistance = resistance * link.target.type.resistancemodifier
         #check for neighbouring enemy attack nodes (or friendly core nodes)
         for link in self.inlinks:
-            if (link.source.type == nodetypes['attack'] and link.source.owner != self.owner and not link.source.specialising()) or (link.source.type == nodetypes['core'] and link.target.owner == self.owner and not link.source.specialising()):
-                resistance = resistance * link.target.resistancemodifier
+            if (link.source.type == nodetypes['attack'] and link.source.owner != self.owner and not link.source.specialising()) or (link.source.type == nodetypes['core'] and link.source.owner == self.owner and not link.source.specialising()):
+                resistance = resistance * link.source.type.resistancemodifier
 
         return resistance * self.energy()
 
     def specialise(self, type):
         #check whether enough energy
-        if self.energy + self.type.consumption - type.consumption <= 0:
+        if self.energy() + self.type.consumption - type.consumption <= 0:
             raise NotEnoughPower()
 
         self.type = type
-        self.buildtime = self.gametime + self.type.buildduration
+        self.buildtime = self.game.time + self.type.buildduration
+        self.game.changednodes.add(self)
 
     def specialising(self):
         #is the node currently specialising into something else?
@@ -452,25 +1938,23 @@ class Node:
                 self.power = -1 * self.power
                 self.tick() #no extra tick, node may be lost again
                 self.setevent(events["corruption"])
-        elif self.type == 'destructor':
+        elif self.type == nodetypes['destructor']:
             for link in self.inlinks:
                 if link.owner == attacker:
                     if link.source.type != nodetypes['unspecialised']:
                         link.source.type = nodetypes['unspecialised']
-        elif self.type == 'core':
+                        self.game.changednodes.add(link.source)
+        elif self.type == nodetypes['core']:
             self.type = nodetypes['unspecialised']
             #does the player have a core left?
-            defeat = True
-            for node in self:
-                if node.type == 'core' and node.owner == self.owner:
-                    defeat = False
-                    break
-            if defeat:
-                self.owner.lost = True
+            owner = self.owner
+            if owner and not self.game.ownership.cores[owner.id]:
+                owner.lost = True
+                self.game.tiles.bumpall(owner)
                 #disown all the player's nodes, specs remain however!
-                for node in self:
-                    if node.owner == self.owner:
-                        node.owner = None
+                for node in self.game.ownership.nodes(owner):
+                    node.owner = None
+                    self.game.changednodes.add(node)
 
 
 
@@ -488,8 +1972,8 @@ class Node:
         attackpower = defaultdict(int)
         for link in self.inlinks:
             if link.owner != self.owner and link.source.type != nodetypes['collaborator']:
-                attackpower[link.source] += link.power
-        for attacker, attack in sorted(attackpower.items(), key= lambda x: x * -1):
+                attackpower[link.owner] += link.power
+        for attacker, attack in sorted(attackpower.items(), key= lambda x: x[1] * -1):
             if attack > self.strength():
                 self.onassimilation(attacker)
                 self.owner = attacker
@@ -523,17 +2007,14 @@ class Node:
 
 
     def neighbours(self, depth = 1):
-        for x in range(min(1,self.x - depth), min(self.x + depth + 1,self.game.width) ):
-            for y in range(min(1,self.y - depth), min(self.y + depth + 1,self.game.height) ):
-                if x != self.x and y != self.y:
-                    if y in self.game.nodes[x]:
-                        yield self.game.nodes[x][y]
+        grid = self.grid
+        return [ Node(self.game, *grid.coordinates(cell)) for cell in grid.spatial.neighbours(self.cell, depth) ]
 
     def visiblenodes(self):
-        if self.specialising():
-            return set([n for n in self.neighbours(1) if n.owner != self.owner])
-        else:
-            return set([n for n in self.neighbours(self.vision) if n.owner != self.owner])
+        grid = self.grid
+        owner = grid.owner
+        radius = 1 if self.specialising() else self.type.vision
+        return set( Node(self.game, *grid.coordinates(cell)) for cell in grid.spatial.neighbours(self.cell, radius) if owner[cell] != owner[self.cell] )
 
     def dict(self):
         #dictionary representation for clients (serialisable to json)
@@ -544,7 +2025,7 @@ class Node:
                 'power': self.power,
                 'energy': self.energy(),
                 'strength': self.strength(),
-                'owner': self.owner.name,
+                'owner': self.owner.name if self.owner else None,
                 'buildtime': self.buildtime,
                 'hidden': self.hidden,
                 'outlinks': [ link.dict() for link in self.outlinks ],
@@ -555,60 +2036,654 @@ class Node:
 
 
 
+class RandomBot:
+    #simple bot for simulations: links a few random owned nodes to random neighbours
+    def __init__(self, seed, name, links=3, fraction=0.5):
+        self.random = random.Random(str(seed) + ':' + name)
+        self.links = links
+        self.fraction = fraction #of the node's energy to put in a link
+
+    def __call__(self, game, player):
+        owned = sorted(game.ownership.owned[player.id])
+        commands = []
+        for cell in self.random.sample(owned, min(self.links, len(owned))):
+            node = Node(game, *game.grid.coordinates(cell))
+            neighbours = list(node.neighbours())
+            power = int(node.energy() * self.fraction)
+            if neighbours and power > 0:
+                target = self.random.choice(neighbours)
+                commands.append({'command': 'link', 'x': node.x, 'y': node.y, 'targetx': target.x, 'targety': target.y, 'power': power})
+        return commands
+
+class IdleBot:
+    #does nothing, a baseline
+    def __init__(self, seed, name):
+        pass
+
+    def __call__(self, game, player):
+        return []
+
+bots = {
+    'random': RandomBot,
+    'idle': IdleBot,
+}
+
+
+class Simulation:
+    #drives a game in-process, without the HTTP layer, for bots, balance testing and replays
+    #all accepted commands are recorded in self.entries (same format as the GameStore journal), so a simulation can be replayed exactly
+
+    def __init__(self, width, height, seed=None, **kwargs):
+        self.game = Game('simulation', width, height, seed=seed, **kwargs)
+        self.game.journal = self
+        self.game.listen(self.ontick)
+        self.entries = []
+        self.owned = [] #per tick: number of nodes owned per player
+        self.winner = None
+
+    def log(self, game, entry):
+        #journal interface, see GameStore.log()
+        self.entries.append(entry)
+
+    def ontick(self, game):
+        self.owned.append(self.countowned())
+
+    def addplayer(self, name):
+        self.game.addplayer(name)
+        return self.game.players[-1]
+
+    def apply(self, player, commands):
+        #applies the commands of a player, like a batch POST, returns the results or the error
+        try:
+            orders = [ self.game.parsecommand(player, command) for command in commands ]
+            return self.game.applycommands(orders, commands)
+        except GameOver:
+            self.gameover()
+            return []
+        except (CommunicationError, NotEnoughPower, NonNeighbourLink) as e:
+            return e
+
+    def gameover(self):
+        for player in self.game.players:
+            if player.wins:
+                self.winner = player
+
+    def countowned(self):
+        return dict( (player.name, len(self.game.ownership.owned[player.id])) for player in self.game.players )
+
+    def turn(self, bots):
+        #one turn: every player that is still in the game gets the commands from his/her bot, then finishes the turn
+        for player in self.game.players:
+            if not player.lost and self.winner is None:
+                commands = bots[player.name](self.game, player) if player.name in bots else []
+                if isinstance(self.apply(player, commands + [{'command': 'done'}]), Exception):
+                    self.apply(player, [{'command': 'done'}]) #bad commands forfeit the turn, not the game
+
+    def run(self, turns, bots):
+        #runs until there is a winner or the number of turns is reached
+        for i in range(turns):
+            if self.winner is not None or all( player.lost for player in self.game.players ):
+                break
+            self.turn(bots)
+        return self.summary()
+
+    def summary(self):
+        return {
+            'seed': self.game.seed,
+            'width': self.game.width,
+            'height': self.game.height,
+            'winner': self.winner.name if self.winner else None,
+            'ticks': self.game.time,
+            'players': [ p.dict() for p in self.game.players ],
+            'owned': self.owned,
+        }
+
+    def replay(self, log):
+        #re-applies a recorded log on this (freshly created, identically seeded) simulation
+        for entry in log:
+            try:
+                self.game.replay(entry)
+            except GameOver:
+                pass
+        self.gameover()
+        return self.summary()
+
+
+def simulate(spec):
+    #runs one simulation from a (picklable) spec, used by simulatemany()
+    #spec: width, height, seed, and optionally players (number), turns, bot (name in bots)
+    simulation = Simulation(spec['width'], spec['height'], seed=spec['seed'])
+    names = [ 'player' + str(i+1) for i in range(spec.get('players', 2)) ]
+    for name in names:
+        simulation.addplayer(name)
+    botclass = bots[spec.get('bot', 'random')]
+    summary = simulation.run(spec.get('turns', simulation_defaultturns), dict( (name, botclass(spec['seed'], name)) for name in names ))
+    if spec.get('record'):
+        summary['log'] = simulation.entries
+    return summary
+
+def simulatemany(specs, processes=None):
+    #runs independent simulations in parallel on a process pool
+    #(relies on the fork start method, as this module is usually loaded from a script)
+    pool = multiprocessing.get_context('fork').Pool(processes)
+    try:
+        return pool.map(simulate, specs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def parseargs(request):
+    #request arguments as keyword arguments, only the first value of each argument is used
+    args = {}
+    for key, values in request.args.items():
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        value = values[0]
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        args[key] = value
+    return args
+
+
 class GameResource(resource.Resource):
+    isLeaf = True
+
     def __init__(self, game):
+        resource.Resource.__init__(self)
         self.game = game
 
+    def render(self, request):
+        #all verbs, instrumented (time spent in the reactor only, a long poll or stream is not counted while it waits)
+        begin = time.time()
+        try:
+            if self.game.profiler is not None and self.game.profiler.kind == 'requests':
+                return self.game.profiler.run(resource.Resource.render, self, request)
+            return resource.Resource.render(self, request)
+        finally:
+            metrics.request(request, time.time() - begin)
+
     def render_GET(self, request):
+        args = parseargs(request)
+        if 'stream' in args:
+            return self.stream(request)
+        return self.get(request, args)
+
+    def get(self, request, args):
         try:
-            request.setHeader('Content-Type', "application/json")
-            return self.game.get(**request.args)
+            #during a tick, answered from the last completed turn (see Game.freeze())
+            etag, body = self.game.getresponse(**args)
+            if args.get('format') == 'binary':
+                request.setHeader('Content-Type', "application/octet-stream")
+            else:
+                request.setHeader('Content-Type', "application/json")
+            if request.setETag(etag.encode('utf-8')) == http.CACHED:
+                return b''
+            return body
         except CommunicationError as e:
             request.setResponseCode(403)
-            return str(e)
+            return str(e).encode('utf-8')
         except Waiting as e:
+            if 'wait' in args:
+                return self.wait(request, args)
             request.setHeader('Content-Type', "application/json")
-            return "{ 'error': 'waiting', 'errormsg': 'Waiting for other players to complete their turn' }"
+            return "{ 'error': 'waiting', 'errormsg': 'Waiting for other players to complete their turn' }".encode('utf-8')
+
+    def wait(self, request, args):
+        #long poll: hold the GET open until the game advances a turn, then answer it as usual
+        def ontick(game):
+            self.game.unlisten(ontick)
+            if timeout.active():
+                timeout.cancel()
+            del args['wait'] #don't wait again
+            request.write(self.get(request, args))
+            request.finish()
+
+        def ontimeout():
+            self.game.unlisten(ontick)
+            request.write("{ 'error': 'waiting', 'errormsg': 'Waiting for other players to complete their turn' }".encode('utf-8'))
+            request.finish()
+
+        def ondisconnect(failure):
+            self.game.unlisten(ontick)
+            if timeout.active():
+                timeout.cancel()
+
+        timeout = reactor.callLater(longpoll_timeout, ontimeout)
+        self.game.listen(ontick)
+        request.notifyFinish().addErrback(ondisconnect)
+        return server.NOT_DONE_YET
+
+    def stream(self, request):
+        #server-sent events: one 'tick' event per turn, with the new game time
+        def ontick(game):
+            request.write(('event: tick\ndata: ' + json.dumps({'time': game.time}) + '\n\n').encode('utf-8'))
+
+        request.setHeader('Content-Type', "text/event-stream")
+        request.setHeader('Cache-Control', "no-cache")
+        ontick(self.game)
+        self.game.listen(ontick)
+        request.notifyFinish().addBoth(lambda result: self.game.unlisten(ontick))
+        return server.NOT_DONE_YET
 
     def render_POST(self, request):
         try:
             request.setHeader('Content-Type', "application/json")
-            return self.game.post(**request.args)
-        except CommunicationError as e:
+            return self.game.post(**parseargs(request)).encode('utf-8')
+        except (CommunicationError, VersionError) as e:
             request.setResponseCode(403)
-            return str(e)
+            return str(e).encode('utf-8')
         except Waiting as e:
             request.setHeader('Content-Type', "application/json")
-            return "{ 'error': 'waiting',  'errormsg': \"" +  str(e) + "\" }"
+            return ("{ 'error': 'waiting',  'errormsg': \"" +  str(e) + "\" }").encode('utf-8')
         except NotEnoughPower as e:
             request.setHeader('Content-Type', "application/json")
-            return "{ 'error': 'notenoughpower', 'errormsg': \"" +  str(e) + "\" }"
+            return ("{ 'error': 'notenoughpower', 'errormsg': \"" +  str(e) + "\" }").encode('utf-8')
         except GameOver as e:
             request.setHeader('Content-Type', "application/json")
-            return "{ 'gameover': 1 }"
+            return "{ 'gameover': 1 }".encode('utf-8')
 
 
 class IndexResource(resource.Resource):
-    def __init__(self, games):
+    def __init__(self, games, store=None, ticker=None):
+        resource.Resource.__init__(self)
         self.games = games
+        self.store = store #GameStore, if games are persisted
+        self.ticker = ticker #for new games, see Game.ticker
+        self.profiledirectory = store.directory if store else tempfile.gettempdir()
 
     def getChild(self, game, request):
-        if game in self.games:
+        if isinstance(game, bytes):
+            game = game.decode('utf-8')
+        if game == '':
+            return self
+        elif game == 'metrics':
+            return MetricsResource(self.games)
+        elif game == 'profile':
+            return ProfileResource(self.games, self.profiledirectory)
+        elif game in self.games:
             return GameResource(self.games[game])
         else:
-            request.setResponseCode(404)
-            return "Game not found"
+            return pages.notFound("No Such Resource", "Game not found")
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', "application/json")
+        return json.dumps({'games': sorted(self.games)}).encode('utf-8')
+
+    def render_POST(self, request):
+        #create a new game
+        try:
+            request.setHeader('Content-Type', "application/json")
+            game = self.creategame(**parseargs(request))
+            return json.dumps(game.dict()).encode('utf-8')
+        except CommunicationError as e:
+            request.setResponseCode(403)
+            return str(e).encode('utf-8')
+
+    def creategame(self, **kwargs):
+        if not kwargs.get('name'):
+            raise CommunicationError("No name specified")
+        if kwargs['name'] in self.games:
+            raise CommunicationError("Game already exists")
+        if kwargs['name'] in reservednames:
+            raise CommunicationError("This name is reserved")
+        try:
+            width = int(kwargs['width'])
+            height = int(kwargs['height'])
+            assert width > 0 and height > 0
+            seed = int(kwargs['seed']) if 'seed' in kwargs else None
+        except:
+            raise CommunicationError("Invalid arguments, expected width and height (and optionally seed)")
+        lazy = str(kwargs.get('lazy')) == '1' #generate the map chunk by chunk as it is explored, for very large maps
+        game = self.games[kwargs['name']] = Game(kwargs['name'], width, height, seed=seed, lazy=lazy)
+        game.ticker = self.ticker
+        if self.store:
+            self.store.attach(game)
+        return game
+
+class MetricsResource(resource.Resource):
+    #metrics in the Prometheus text format, plus gauges and cache counters per game
+    isLeaf = True
+
+    def __init__(self, games):
+        resource.Resource.__init__(self)
+        self.games = games
+
+    def render_GET(self, request):
+        games = sorted(self.games.items())
+        values = dict( (name, game.ticking['gauges'] if game.ticking is not None else game.gauges()) for name, game in games ) #during a tick, those of the last completed turn
+        gauges = [
+            ('battlenode_games', "Games hosted by this process", [ ((), len(games)) ]),
+            ('battlenode_game_players', "Players in the game that did not lose", [ ((('game', name),), values[name]['players']) for name, game in games ]),
+            ('battlenode_game_owned_nodes', "Nodes owned by players", [ ((('game', name),), values[name]['owned']) for name, game in games ]),
+            ('battlenode_game_links', "Links between nodes", [ ((('game', name),), values[name]['links']) for name, game in games ]),
+            ('battlenode_game_time', "Game time (turn)", [ ((('game', name),), values[name]['time']) for name, game in games ]),
+        ]
+        counters = [
+            ('battlenode_node_cache_hits_total', "Energy and strength lookups answered from the node cache, per kind", [ ((('game', name), ('kind', kind)), game.cache.hits[kind]) for name, game in games for kind in NodeCache.kinds ]),
+            ('battlenode_node_cache_misses_total', "Energy and strength lookups that had to be computed, per kind", [ ((('game', name), ('kind', kind)), game.cache.misses[kind]) for name, game in games for kind in NodeCache.kinds ]),
+            ('battlenode_response_cache_hits_total', "GET responses served from the response cache", [ ((('game', name),), game.responses.hits) for name, game in games ]),
+            ('battlenode_response_cache_misses_total', "GET responses that had to be rendered", [ ((('game', name),), game.responses.misses) for name, game in games ]),
+        ]
+        request.setHeader('Content-Type', "text/plain; version=0.0.4")
+        return metrics.render(gauges, counters).encode('utf-8')
+
+
+class Profiler:
+    #profiles the next ticks or requests (through GameResource) of one game, then saves the profile as a pstats file and
+    #keeps a summary in game.lastprofile. Ticks are profiled by replacing the game's tick() (an instance attribute that
+    #shadows Game.tick, removed again when done), so a game that is not profiled runs exactly the same code as before
+
+    def __init__(self, game, kind, count, directory):
+        self.game = game
+        self.kind = kind #'ticks' or 'requests'
+        self.count = self.remaining = count
+        self.directory = directory
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.game.profiler = self
+        if self.kind == 'ticks':
+            self.game.tick = self.tick
+
+    def tick(self, notify=True):
+        return self.run(Game.tick, self.game, notify)
+
+    def run(self, f, *args):
+        #only the calling thread is profiled, that is the tick's thread for ticks in a thread (see tickinthread())
+        try:
+            return self.profile.runcall(f, *args)
+        finally:
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.finish()
+
+    def finish(self):
+        game = self.game
+        if self.kind == 'ticks':
+            del game.tick
+        game.profiler = None
+        path = os.path.join(self.directory, quote(game.name, safe='') + '.' + str(game.time) + '.' + self.kind + '.pstats')
+        self.profile.dump_stats(path)
+        stats = pstats.Stats(self.profile)
+        functions = sorted(stats.stats.items(), key=lambda item: -item[1][3])[:profile_summarylines]
+        game.lastprofile = {
+            'kind': self.kind,
+            'count': self.count,
+            'time': game.time,
+            'path': path,
+            'total': stats.total_tt,
+            'functions': [ {'function': filename + ':' + str(line) + '(' + function + ')', 'calls': calls, 'tottime': tottime, 'cumtime': cumtime} for (filename, line, function), (primitivecalls, calls, tottime, cumtime, callers) in functions ],
+        }
+        log.msg("Profile of " + str(self.count) + " " + self.kind + " of game " + game.name + " saved to " + path)
+
+
+class ProfileResource(resource.Resource):
+    #admin: POST with game=name and ticks=N (or requests=N) profiles the next N ticks (or requests) of that game,
+    #GET with game=name tells whether it is being profiled, and gives the summary of the last profile:
+    #the most expensive functions by cumulative time, and the path of the pstats file with the full profile
+    isLeaf = True
+
+    def __init__(self, games, directory):
+        resource.Resource.__init__(self)
+        self.games = games
+        self.directory = directory
+
+    def getgame(self, args):
+        if args.get('game') not in self.games:
+            raise CommunicationError("Game not found")
+        return self.games[args['game']]
+
+    def render_GET(self, request):
+        try:
+            game = self.getgame(parseargs(request))
+        except CommunicationError as e:
+            request.setResponseCode(403)
+            return str(e).encode('utf-8')
+        d = {'game': game.name, 'active': None, 'last': game.lastprofile}
+        if game.profiler is not None:
+            d['active'] = {'kind': game.profiler.kind, 'count': game.profiler.count, 'remaining': game.profiler.remaining}
+        request.setHeader('Content-Type', "application/json")
+        return json.dumps(d).encode('utf-8')
+
+    def render_POST(self, request):
+        args = parseargs(request)
+        try:
+            game = self.getgame(args)
+            if game.profiler is not None:
+                raise CommunicationError("Game is already being profiled")
+            kinds = [ kind for kind in ('ticks', 'requests') if kind in args ]
+            if len(kinds) != 1:
+                raise CommunicationError("Expected the number of ticks or of requests to profile")
+            try:
+                count = int(args[kinds[0]])
+                assert count > 0
+            except:
+                raise CommunicationError("Invalid number of " + kinds[0])
+        except CommunicationError as e:
+            request.setResponseCode(403)
+            return str(e).encode('utf-8')
+        Profiler(game, kinds[0], count, self.directory).start()
+        request.setHeader('Content-Type', "application/json")
+        return json.dumps({'game': game.name, 'kind': kinds[0], 'count': count}).encode('utf-8')
+
+
+def tickinthread(game):
+    #Game.ticker that runs the tick in the reactor's thread pool, so requests (for all games) are still served meanwhile
+    #the game is frozen right away, before the request that completed the turn returns, so nothing is accepted (or
+    #journalled) between that done and the tick; GETs are answered from the last completed turn meanwhile (see
+    #Game.freeze()). When the tick completes the game is thawed on the reactor thread and the listeners are notified
+    def start():
+        threads.deferToThread(tick).addCallbacks(done, failed)
+
+    def tick():
+        try:
+            game.tick(notify=False)
+        except GameOver:
+            pass #the players' records tell who won
+
+    def done(result):
+        game.thaw()
+        game.recordtick()
+        game.notify()
+
+    def failed(failure):
+        game.thaw()
+        log.err(failure, "Tick of game " + game.name + " failed")
+
+    game.freeze()
+    reactor.callLater(0, start) #the tick itself only after the request that completed the turn is answered
+
 
 class BattleNodeServer:
-    def __init__(self, port):
+    def __init__(self, port, interface='', games=None, worker=False, run=True, datadir=None, shard=None, syncticks=False):
         assert isinstance(port, int)
-        self.games = {}
-        reactor.listenTCP(port, server.Site(IndexResource(self.games)))
-        reactor.run()
+        self.games = {} if games is None else games
+        ticker = None if syncticks else tickinthread
+        if datadir:
+            #persisted games: restore them (as a shard worker, only those of our own shard)
+            self.store = GameStore(datadir)
+            for name in self.store.games():
+                if shard is None or shardof(name, shard[1]) == shard[0]:
+                    log.msg("Restoring game " + name)
+                    self.games[name] = self.store.restore(name)
+        else:
+            self.store = None
+        for game in self.games.values():
+            game.ticker = ticker
+        reactor.listenTCP(port, server.Site(IndexResource(self.games, self.store, ticker)), interface=interface)
+        reactor.callWhenRunning(metrics.startlagprobe)
+        if worker:
+            #we are a shard worker: tell the router we're listening, and quit when the router goes away
+            reactor.callWhenRunning(self.ready)
+            task.LoopingCall(self.checkparent, os.getppid()).start(shard_parentcheckinterval, now=False)
+        if run:
+            reactor.run()
+
+    def ready(self):
+        sys.stdout.write("ready\n")
+        sys.stdout.flush()
+
+    def checkparent(self, parent):
+        if os.getppid() != parent:
+            reactor.stop()
+
+
+def shardof(game, shards):
+    #stable assignment of a game to one of the shards
+    return zlib.crc32(game.encode('utf-8')) % shards
+
+
+class ShardWorker(protocol.ProcessProtocol):
+    #a worker process that hosts a shard of the games on a local port, restarted when it dies
+
+    def __init__(self, router, index, port):
+        self.router = router
+        self.index = index
+        self.port = port
+        self.alive = False #accepting requests?
+        self.process = None
+        self.starts = 0
+
+    def start(self):
+        self.alive = False
+        self.starts += 1
+        args = [sys.executable, os.path.abspath(__file__), '--worker', '--port', str(self.port), '--shard', str(self.index), '--workers', str(len(self.router.workers))]
+        if self.router.datadir:
+            args += ['--datadir', self.router.datadir]
+        if self.router.syncticks:
+            args += ['--syncticks']
+        self.process = reactor.spawnProcess(self, sys.executable, args, env=os.environ, childFDs={0: 'w', 1: 'r', 2: 2})
+
+    def outReceived(self, data):
+        if b'ready' in data:
+            self.alive = True
+
+    def processEnded(self, reason):
+        self.alive = False
+        self.process = None
+        if not self.router.stopping:
+            log.msg("Shard worker " + str(self.index) + " ended (" + str(reason.value) + "), restarting")
+            reactor.callLater(shard_restartdelay, self.start)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.signalProcess('TERM')
+
+    def dict(self):
+        return {
+            'index': self.index,
+            'port': self.port,
+            'pid': self.process.pid if self.process else None,
+            'alive': self.alive,
+            'restarts': max(self.starts - 1, 0),
+        }
+
+
+class ShardRouter:
+    #front router: games are assigned to worker processes by a stable hash of their name
+
+    def __init__(self, workers, workerport, datadir=None, syncticks=False):
+        self.workers = [ ShardWorker(self, i, workerport + i) for i in range(workers) ]
+        self.datadir = datadir #passed on to the workers, so they restore their games when (re)started
+        self.syncticks = syncticks
+        self.stopping = False
+        for worker in self.workers:
+            worker.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def shard(self, game):
+        return self.workers[shardof(game, len(self.workers))]
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers:
+            worker.stop()
+
+
+class ShardRouterResource(resource.Resource):
+    def __init__(self, router):
+        resource.Resource.__init__(self)
+        self.router = router
+
+    def getChild(self, game, request):
+        if isinstance(game, bytes):
+            game = game.decode('utf-8')
+        path = b'/' + game.encode('utf-8')
+        if game == 'shards':
+            return ShardsResource(self.router)
+        elif game == 'metrics':
+            #of the router process itself, or with shard=N of that worker: its games, ticks and requests
+            args = parseargs(request)
+            if 'shard' not in args:
+                return MetricsResource({})
+            try:
+                worker = self.router.workers[int(args['shard'])] if int(args['shard']) >= 0 else None
+            except (ValueError, IndexError):
+                worker = None
+            if worker is None:
+                return pages.errorPage(403, "Forbidden", "No such shard")
+            return self.forward(worker, path, request)
+        elif game == 'profile':
+            #route by the game to profile
+            args = parseargs(request)
+            if not args.get('game'):
+                return pages.errorPage(403, "Forbidden", "No game specified")
+            game = args['game']
+        elif game == '':
+            #creating a game, route by the name of the new game
+            args = parseargs(request)
+            if request.method != b'POST' or not args.get('name'):
+                return pages.errorPage(403, "Forbidden", "Games can only be listed per shard, see /shards")
+            game = args['name']
+            path = b'/'
+        return self.forward(self.router.shard(game), path, request)
+
+    def forward(self, worker, path, request):
+        if not worker.alive:
+            request.setHeader('Retry-After', str(shard_restartdelay + 1))
+            return pages.errorPage(503, "Service Unavailable", "Shard " + str(worker.index) + " is restarting, try again shortly")
+        return proxy.ReverseProxyResource('127.0.0.1', worker.port, path)
+
+
+class ShardsResource(resource.Resource):
+    #introspection: the workers, and with ?game=name, which worker hosts that game
+    isLeaf = True
+
+    def __init__(self, router):
+        resource.Resource.__init__(self)
+        self.router = router
+
+    def render_GET(self, request):
+        args = parseargs(request)
+        d = {'workers': [ worker.dict() for worker in self.router.workers ]}
+        if 'game' in args:
+            d['game'] = args['game']
+            d['shard'] = self.router.shard(args['game']).index
+        request.setHeader('Content-Type', "application/json")
+        return json.dumps(d).encode('utf-8')
 
 
 def main():
-    BattleNodeServer(7455)
+    parser = argparse.ArgumentParser(description="BattleNode server")
+    parser.add_argument('-p', '--port', type=int, help="Port to listen on", default=7455)
+    parser.add_argument('--workers', type=int, help="Sharded mode: host the games in this many worker processes, behind a router on --port", default=0)
+    parser.add_argument('--workerport', type=int, help="First local port for the worker processes in sharded mode (default: port+1)", default=None)
+    parser.add_argument('-d', '--datadir', type=str, help="Persist games (snapshots and command journals) in this directory, and restore them on start", default=None)
+    parser.add_argument('--syncticks', action='store_true', help="Run game ticks on the reactor thread, all requests wait while a game ticks")
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS) #internal, started by the router
+    parser.add_argument('--shard', type=int, help=argparse.SUPPRESS, default=0) #internal, index of the worker
+    args = parser.parse_args()
+
+    if args.worker:
+        BattleNodeServer(args.port, interface='127.0.0.1', worker=True, datadir=args.datadir, shard=(args.shard, args.workers), syncticks=args.syncticks)
+    elif args.workers > 0:
+        router = ShardRouter(args.workers, args.workerport or args.port + 1, args.datadir, args.syncticks)
+        reactor.listenTCP(args.port, server.Site(ShardRouterResource(router)))
+        reactor.callWhenRunning(metrics.startlagprobe)
+        reactor.run()
+    else:
+        BattleNodeServer(args.port, datadir=args.datadir, syncticks=args.syncticks)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+#Headless batch simulations of BattleNode games, for bot tuning and balance testing
+#usage: battlenode-sim.py [-n games] [-W width] [-H height] [-t turns] [--bot random] [--record file.jsonl]
+#       battlenode-sim.py --replay file.jsonl
+
+import sys
+import os
+import json
+import argparse
+import importlib.util
+from collections import Counter
+
+def loadserver():
+    #the engine lives in a script (battlenode-server.py), load it as a module
+    #(registered in sys.modules, so the process pool can find the simulation function)
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'battlenode-server.py')
+    spec = importlib.util.spec_from_file_location('battlenode', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['battlenode'] = module
+    spec.loader.exec_module(module)
+    return module
+
+battlenode = loadserver()
+
+
+def printsummary(summary):
+    final = summary['owned'][-1] if summary['owned'] else {}
+    print("seed %-6s winner %-10s ticks %-5d owned %s" % (summary['seed'], summary['winner'], summary['ticks'], " ".join( name + "=" + str(count) for name, count in sorted(final.items()) )))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless BattleNode simulations")
+    parser.add_argument('-n', '--games', type=int, help="Number of games", default=8)
+    parser.add_argument('-W', '--width', type=int, default=50)
+    parser.add_argument('-H', '--height', type=int, default=50)
+    parser.add_argument('-t', '--turns', type=int, help="Maximum number of turns per game", default=battlenode.simulation_defaultturns)
+    parser.add_argument('-p', '--players', type=int, default=2)
+    parser.add_argument('-s', '--seed', type=int, help="Seed of the first game, the others follow", default=1)
+    parser.add_argument('--bot', type=str, help="Bot for all players: " + ", ".join(sorted(battlenode.bots)), default='random')
+    parser.add_argument('-j', '--processes', type=int, help="Number of processes (default: number of cores)", default=None)
+    parser.add_argument('--record', type=str, help="Write the summary and command log of every game to this file (JSON lines)", default=None)
+    parser.add_argument('--replay', type=str, help="Replay the games recorded in this file and check the outcome", default=None)
+    args = parser.parse_args()
+
+    if args.replay:
+        mismatches = 0
+        for line in open(args.replay):
+            recorded = json.loads(line)
+            simulation = battlenode.Simulation(recorded['width'], recorded['height'], seed=recorded['seed'])
+            summary = simulation.replay(recorded['log'])
+            printsummary(summary)
+            if summary['winner'] != recorded['winner'] or summary['owned'] != recorded['owned']:
+                print("  MISMATCH with recorded outcome")
+                mismatches += 1
+        sys.exit(1 if mismatches else 0)
+
+    specs = [ {'width': args.width, 'height': args.height, 'seed': args.seed + i, 'players': args.players, 'turns': args.turns, 'bot': args.bot, 'record': bool(args.record)} for i in range(args.games) ]
+    summaries = battlenode.simulatemany(specs, args.processes)
+    for summary in summaries:
+        printsummary(summary)
+    wins = Counter( summary['winner'] for summary in summaries )
+    print("wins: " + ", ".join( str(name) + "=" + str(count) for name, count in sorted(wins.items(), key=lambda x: str(x[0])) ))
+    print("average ticks: %.1f" % (sum( summary['ticks'] for summary in summaries ) / float(len(summaries))))
+    if args.record:
+        f = open(args.record, 'w')
+        for summary in summaries:
+            f.write(json.dumps(summary) + "\n")
+        f.close()
+
+if __name__ == '__main__':
+    main()